@@ -0,0 +1,56 @@
+# Create a tiny random-weight Llama checkpoint with a chat template
+# for testing the translation pipeline without downloading a model
+
+import fire, tokenizers, transformers
+from tokenizers import decoders, models, pre_tokenizers, trainers
+
+
+def main(output: str = "tiny-random-llama", vocab_size: int = 512):
+
+    corpus = [
+        "subroutine fillSij(p)\n  use constants\n  real(dp):: p(mxpart,4)\nend subroutine\n",
+        "function dot(p,i,j)\n  integer:: i,j\n  dot=p(i,4)*p(j,4)\n  return\nend\n",
+        "#include <complex>\nvoid dot(double& x) {\n  return;\n}\n",
+    ]
+
+    tokenizer = tokenizers.Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(
+        corpus * 10,
+        trainers.BpeTrainer(
+            vocab_size=vocab_size,
+            special_tokens=["<unk>", "<s>", "</s>"],
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        ),
+    )
+
+    tokenizer = transformers.PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<s>",
+        eos_token="</s>",
+        unk_token="<unk>",
+    )
+    tokenizer.chat_template = (
+        "{{ bos_token }}{% for message in messages %}"
+        + "[{{ message['role'] }}]{{ message['content'] }}{% endfor %}"
+        + "{% if add_generation_prompt %}[assistant]{% endif %}"
+    )
+    tokenizer.save_pretrained(output)
+
+    config = transformers.LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=8192,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    transformers.LlamaForCausalLM(config).save_pretrained(output)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,5 @@
+# Bash script for `jobrunner` to create a tiny random-weight model
+# for smoke tests of the translation pipeline on CPU-only nodes
+if [ ! -d "tiny-random-llama" ]; then
+	python3 createModel.py tiny-random-llama
+fi
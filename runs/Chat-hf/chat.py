@@ -6,8 +6,14 @@ import fire
 import transformers
 import torch
 import json
+import urllib.request
 from types import SimpleNamespace
-import os
+import os, sys
+
+for path in os.getenv("PYMODULE_PATH").split(":"):
+    sys.path.insert(0, path)
+
+import engine
 
 Color = SimpleNamespace(
     purple="\033[95m",
@@ -23,45 +29,254 @@ Color = SimpleNamespace(
 )
 
 
+def load_model(llm_choice=None, precision=None):
+    """
+    Prompt for a model unless one was chosen and load its tokenizer and
+    pipeline with engine.load_pipeline. The model is placed on the first
+    GPU if available and the CPU otherwise.
+
+    Arguments
+    ---------
+    llm_choice : Integer value of model option, prompted for if None
+    precision  : String value of fp32, fp16, bf16 or int8. Defaults to
+                 fp32 on CPU and fp16 otherwise
+    """
+    names = list(engine.checkpoints)
+
+    if llm_choice is None:
+        llm_choice = input(
+            f"{Color.darkcyan}Welcome to a simple AI powered chat that uses the transformers API "+
+            f"to test different models."
+            + "".join(f"\n\t{index}. {name}" for index, name in enumerate(names, 1))
+            + f"\nSelect the model you would like to interact with: "
+        )
+
+        print(f"{Color.end}")
+
+    if str(llm_choice) not in [str(option) for option in range(1, len(names) + 1)]:
+        raise ValueError(f"Option {llm_choice} not defined")
+
+    ckpt_dir = (
+        os.getenv("MODEL_HOME") + os.sep + engine.checkpoints[names[int(llm_choice) - 1]]
+    )
+
+    device = 0 if torch.cuda.is_available() else "cpu"
+
+    pipeline = engine.load_pipeline(ckpt_dir, device, precision)
+
+    return ckpt_dir, pipeline.tokenizer, pipeline
+
+
+class ChatSession:
+    """
+    Generation state of a local chat. The KV cache of the previous turns
+    is kept between calls, so only tokens that differ from the cached
+    prefix are prefilled, usually just the reply and the new user
+    message. When the history is compacted the cache is cropped to the
+    part of the prompt that is unchanged.
+
+    Arguments
+    ---------
+    model     : Causal language model
+    tokenizer : Tokenizer for the model
+    """
+
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.cache = transformers.DynamicCache()
+        self.cached_ids = []
+
+    def generate(self, conversation, **kwargs):
+        """
+        Return reply to the conversation, reusing the KV cache of the
+        longest prefix shared with the previous prompt
+
+        Arguments
+        ---------
+        conversation : List of chat messages
+        kwargs       : Keyword arguments passed to generate
+        """
+        input_ids = engine.encode(self.tokenizer, conversation)
+
+        # At least one prompt token has to be prefilled to get logits
+        common = 0
+        for cached, token in zip(self.cached_ids, input_ids[:-1]):
+            if cached != token:
+                break
+            common += 1
+        if self.cache.get_seq_length() > common:
+            self.cache.crop(common - self.cache.get_seq_length())
+
+        output_ids = self.model.generate(
+            input_ids=torch.tensor([input_ids], device=self.model.device),
+            attention_mask=torch.ones(
+                1, len(input_ids), dtype=torch.long, device=self.model.device
+            ),
+            past_key_values=self.cache,
+            **kwargs,
+        )[0].tolist()
+
+        # The last generated token is never fed back, so it is not cached
+        self.cached_ids = output_ids[: self.cache.get_seq_length()]
+        return self.tokenizer.decode(
+            output_ids[len(input_ids) :], skip_special_tokens=True
+        )
+
+
+def summarize_turns(generate, turns):
+    """
+    Ask the model for a summary of chat turns and return it
+
+    Arguments
+    ---------
+    generate : Function that returns the reply to a conversation
+    turns    : List of chat messages to summarize
+    """
+    transcript = "\n\n".join(
+        f"{turn['role'].upper()}: {turn['content']}" for turn in turns
+    )
+    return generate(
+        [
+            dict(
+                role="user",
+                content="Summarize the following conversation in a few sentences. "
+                + "Keep code, file names, errors and decisions that later "
+                + f"questions may refer to.\n\n{transcript}",
+            )
+        ]
+    )
+
+
+def compact_history(instructions, count_tokens, budget, policy, generate=None):
+    """
+    Return history that fits the token budget. The oldest user and
+    assistant turns are removed in pairs until the prompt fits in half
+    of the budget, so compaction runs rarely and the cached prefix stays
+    valid for many turns in between. With the summarize policy the
+    removed turns are replaced by a summary prepended to the first
+    remaining user message, which keeps roles alternating as chat
+    templates require.
+
+    Arguments
+    ---------
+    instructions : List of chat messages ending with a user message
+    count_tokens : Function that returns prompt length of a conversation
+    budget       : Integer value of maximum prompt tokens
+    policy       : String value of truncate, summarize or none
+    generate     : Function that returns the reply to a conversation,
+                   used by the summarize policy
+    """
+    if policy == "none" or count_tokens(instructions) <= budget:
+        return instructions
+
+    if policy not in ["truncate", "summarize"]:
+        raise ValueError(f"Compaction policy {policy} not defined")
+
+    removed = []
+    kept = list(instructions)
+    while len(kept) > 1 and count_tokens(kept) > budget // 2:
+        removed.extend(kept[:2])
+        kept = kept[2:]
+
+    if policy == "summarize" and removed:
+        summary = summarize_turns(generate, removed)
+        kept[0] = dict(
+            kept[0],
+            content=f"Summary of the earlier conversation:\n{summary}\n\n"
+            + kept[0]["content"],
+        )
+
+    print(
+        f"{Color.darkcyan}Compacted {len(removed)} messages with the {policy} "
+        + f"policy{Color.end}\n"
+    )
+    return kept
+
+
+def query_server(server, path, request=None):
+    """
+    Send request to the inference server in runs/Server-hf
+
+    Arguments
+    ---------
+    server  : String value of server address like http://127.0.0.1:8000
+    path    : String value of endpoint path
+    request : Dictionary sent as JSON body, GET request if None
+    """
+    if request is not None:
+        request = urllib.request.Request(
+            server.rstrip("/") + path,
+            data=json.dumps(request).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+    else:
+        request = server.rstrip("/") + path
+
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+
 def main(
+    llm_choice: Optional[int] = None,
     max_new_tokens: int = 2048,
     batch_size: int = 8,
     max_length: Optional[int] = None,
+    stream: bool = True,
+    server: Optional[str] = None,
+    precision: Optional[str] = None,
+    compaction: str = "truncate",
+    max_context_tokens: Optional[int] = None,
+    summary_tokens: int = 256,
 ):
 
-    choice = input(
-        f"{Color.darkcyan}Welcome to a simple AI powered chat that uses the transformers API "+
-        f"to test different models.\n\t1. mistral-7b\n\t2. codellama-7b\n\t3. gemma-7b\nSelect "+
-        f"the model you would like to interact with: "
-    )
+    if server:
+        ckpt_dir = query_server(server, "/health")["ckpt_dir"]
+        print(f"{Color.darkcyan}Using inference server {server} serving {ckpt_dir}{Color.end}")
+        tokenizer = transformers.AutoTokenizer.from_pretrained(ckpt_dir)
+        config = transformers.AutoConfig.from_pretrained(ckpt_dir)
+        # The server returns replies after the full generation
+        stream = False
 
-    print(f"{Color.end}")
+        def generate(conversation, max_new_tokens=max_new_tokens, **kwargs):
+            return query_server(
+                server,
+                "/generate",
+                dict(
+                    conversations=[conversation],
+                    max_new_tokens=max_new_tokens,
+                    max_length=max_length,
+                    eos_token_id=tokenizer.eos_token_id,
+                ),
+            )["outputs"][0]
 
-    if int(choice) == 1:
-        ckpt_dir = os.getenv("MODEL_HOME") + os.sep + "mistral/Mistral-7B-Instruct-v0.1"
-    elif int(choice) == 2:
-        ckpt_dir = (
-            os.getenv("MODEL_HOME") + os.sep + "codellama/CodeLlama-7b-Instruct-hf"
-        )
-    elif int(choice) == 3:
-        ckpt_dir = (
-            os.getenv("MODEL_HOME") + os.sep + "google/gemma-7b-it"
-        )    
     else:
-        raise ValueError(f"Option {choice} not defined")
+        ckpt_dir, tokenizer, pipeline = load_model(llm_choice, precision)
+        config = pipeline.model.config
+        session = ChatSession(pipeline.model, tokenizer)
 
-    tokenizer = transformers.AutoTokenizer.from_pretrained(ckpt_dir)
+        def generate(conversation, max_new_tokens=max_new_tokens, **kwargs):
+            return session.generate(
+                conversation,
+                max_new_tokens=max_new_tokens,
+                max_length=max_length,
+                # temperature=temperature,
+                # top_p=top_p,
+                # do_sample=True,
+                eos_token_id=tokenizer.eos_token_id,
+                pad_token_id=tokenizer.eos_token_id,
+                **kwargs,
+            )
 
-    pipeline = transformers.pipeline(
-        "text-generation",
-        model=ckpt_dir,
-        torch_dtype=torch.float16,
-        device=0,
-    )
+    # Prompt tokens left after reserving room for the reply
+    max_context_tokens = max_context_tokens or config.max_position_embeddings
+    budget = max_context_tokens - max_new_tokens
 
     chat_name = input(f"{Color.darkcyan}Enter chat transcript name: ")
     print("")
 
+    # Full transcript and the possibly compacted context sent to the model
+    history = []
     instructions = []
 
     while True:
@@ -70,27 +285,33 @@ def main(
         if prompt.upper() == "EXIT":
             break
 
-        instructions.append(dict(role="user", content=prompt))
-
-        results = pipeline(
-            instructions,
-            max_new_tokens=max_new_tokens,
-            max_length=max_length,
-            batch_size=batch_size,
-            # temperature=temperature,
-            # top_p=top_p,
-            # do_sample=True,
-            eos_token_id=tokenizer.eos_token_id,
-            pad_token_id=50256,
+        message = dict(role="user", content=prompt)
+        history.append(message)
+        instructions = compact_history(
+            instructions + [message],
+            lambda conversation: len(engine.encode(tokenizer, conversation)),
+            budget,
+            compaction,
+            lambda conversation: generate(conversation, max_new_tokens=summary_tokens),
         )
 
-        for result in results:
-            print(
-                f"{Color.blue}{result['generated_text'][-1]['role'].upper()}: "+
-                f"{result['generated_text'][-1]['content']}{Color.end}"
+        if stream:
+            print(f"{Color.blue}ASSISTANT: ", end="", flush=True)
+            output = generate(
+                instructions,
+                streamer=transformers.TextStreamer(
+                    tokenizer, skip_prompt=True, skip_special_tokens=True
+                ),
             )
-            print("")
-            instructions.append(result["generated_text"][-1])
+            print(f"{Color.end}")
+        else:
+            output = generate(instructions)
+            print(f"{Color.blue}ASSISTANT: {output}{Color.end}")
+        print("")
+
+        reply = dict(role="assistant", content=output)
+        history.append(reply)
+        instructions.append(reply)
 
     with open(f"{chat_name}.json", "w") as outfile:
         json.dump(
@@ -100,8 +321,12 @@ def main(
                     max_new_tokens=max_new_tokens,
                     max_length=max_length,
                     batch_size=batch_size,
+                    precision=precision,
+                    compaction=compaction,
+                    max_context_tokens=max_context_tokens,
                 ),
-                "chat": instructions,
+                "chat": history,
+                "context": instructions,
             },
             outfile,
             indent=2,
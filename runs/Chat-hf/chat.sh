@@ -1 +1,5 @@
-torchrun --nproc_per_node 1 $JobWorkDir/job.target
+# Set environment variable for the translation engine modules, model
+# loading is shared with Translate-hf
+export PYMODULE_PATH="$PWD/../Translate-hf:$PWD/../Translate-hf/latest:$PYMODULE_PATH"
+
+torchrun --nproc_per_node 1 $JobWorkDir/job.target ${LLM_CHOICE:+--llm_choice $LLM_CHOICE}
@@ -0,0 +1,11 @@
+# Shell script for deploying the inference server. This
+# script executes job.target defined in Jobfile.
+
+# Set environment variable for the translation engine modules, model
+# loading and the continuous batching scheduler are shared with Translate-hf
+export PYMODULE_PATH="$PWD/../Translate-hf:$PWD/../Translate-hf/latest:$PYMODULE_PATH"
+
+# Execute python command and deploy job.target
+python3 $JobWorkDir/job.target --llm_choice ${LLM_CHOICE:-1} --port ${SERVER_PORT:-8000} \
+                              --continuous ${SERVER_CONTINUOUS:-False} \
+                              ${SERVER_PRECISION:+--precision $SERVER_PRECISION}
@@ -0,0 +1,198 @@
+# Long-lived inference server that loads a checkpoint once and serves
+# translation and chat requests over localhost HTTP
+
+# Import libraries
+from typing import Optional
+import fire
+import torch
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+import os, sys
+
+for path in os.getenv("PYMODULE_PATH").split(":"):
+    sys.path.insert(0, path)
+
+import scheduler, engine, stopping
+
+Color = SimpleNamespace(
+    purple="\033[95m",
+    cyan="\033[96m",
+    darkcyan="\033[36m",
+    blue="\033[94m",
+    green="\033[92m",
+    yellow="\033[93m",
+    red="\033[91m",
+    bold="\033[1m",
+    underline="\033[4m",
+    end="\033[0m",
+)
+
+
+def generate_continuous(pipeline, batcher, conversations, request):
+    """
+    Submit conversations to a running continuous batcher and wait for
+    the results. Decoding is greedy, so sampling options are ignored.
+
+    Arguments
+    ---------
+    pipeline      : Text generation pipeline
+    batcher       : ContinuousBatcher running in a background thread
+    conversations : List of conversations
+    request       : Dictionary of generation parameters
+    """
+    futures = []
+    for conversation in conversations:
+        prompt = pipeline.tokenizer.apply_chat_template(
+            conversation, tokenize=False, add_generation_prompt=True
+        )
+        input_ids = pipeline.tokenizer(prompt, add_special_tokens=False)["input_ids"]
+        max_new_tokens = request.get("max_new_tokens", 256)
+        if request.get("max_length"):
+            max_new_tokens = min(max_new_tokens, request["max_length"] - len(input_ids))
+        stop_check = (
+            stopping.StopCheck(pipeline.tokenizer, **request["early_stop"])
+            if request.get("early_stop")
+            else None
+        )
+        futures.append(batcher.submit(input_ids, max_new_tokens, stop_check))
+
+    results = []
+    for future in futures:
+        output_ids, stop_reason = future.result()
+        results.append(
+            engine.create_result(pipeline.tokenizer, output_ids, stop_reason=stop_reason)
+        )
+    return results
+
+
+def create_handler(pipeline, ckpt_dir, batcher=None):
+    """
+    Create request handler class bound to a loaded pipeline. Requests
+    are handled in separate threads. Without a batcher, generation is
+    serialized with a lock so that only one batch runs on the device at
+    a time, otherwise requests join the running batch of the batcher.
+
+    Arguments
+    ---------
+    pipeline : Text generation pipeline
+    ckpt_dir : String value of checkpoint directory
+    batcher  : ContinuousBatcher running in a background thread or None
+    """
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, value):
+            content = json.dumps(value).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.send_json(200, dict(status="ok", ckpt_dir=ckpt_dir))
+            else:
+                self.send_json(404, dict(error=f"Unknown path {self.path}"))
+
+        def do_POST(self):
+            if self.path != "/generate":
+                self.send_json(404, dict(error=f"Unknown path {self.path}"))
+                return
+
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            conversations = request.pop("conversations")
+            request.pop("pad_token_id", None)
+
+            try:
+                if batcher:
+                    results = generate_continuous(
+                        pipeline, batcher, conversations, request
+                    )
+                else:
+                    with lock:
+                        results = engine.generate_batch(
+                            pipeline.model,
+                            pipeline.tokenizer,
+                            conversations,
+                            pad_token_id=pipeline.tokenizer.pad_token_id,
+                            **request,
+                        )
+            except Exception as error:
+                self.send_json(500, dict(error=str(error)))
+                return
+
+            self.send_json(
+                200,
+                dict(outputs=[result["output"] for result in results], results=results),
+            )
+
+        def log_message(self, format, *args):
+            print(f"{Color.blue}{self.address_string()} {format % args}{Color.end}")
+
+    return Handler
+
+
+def main(
+    llm_choice: Optional[int] = None,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    continuous: bool = False,
+    max_batch_size: int = 8,
+    max_tokens_in_flight: int = 65536,
+    precision: Optional[str] = None,
+):
+
+    names = list(engine.checkpoints)
+
+    if llm_choice is None:
+        llm_choice = input(
+            f"{Color.darkcyan}Inference server that uses the transformers API "+
+            f"to serve different models."
+            + "".join(f"\n\t{index}. {name}" for index, name in enumerate(names, 1))
+            + f"\nSelect the model you would like to serve: "
+        )
+        print(f"{Color.end}")
+
+    if str(llm_choice) not in [str(option) for option in range(1, len(names) + 1)]:
+        raise ValueError(f"Option {llm_choice} not defined")
+
+    ckpt_dir = (
+        os.getenv("MODEL_HOME") + os.sep + engine.checkpoints[names[int(llm_choice) - 1]]
+    )
+
+    device = 0 if torch.cuda.is_available() else "cpu"
+
+    pipeline = engine.load_pipeline(ckpt_dir, device, precision)
+    engine.configure_padding(pipeline.tokenizer)
+
+    # Requests from all clients share one running batch on the device
+    if continuous:
+        batcher = scheduler.ContinuousBatcher(
+            pipeline.model,
+            pipeline.tokenizer.eos_token_id,
+            max_batch_size,
+            max_tokens_in_flight,
+        )
+        threading.Thread(
+            target=batcher.run, kwargs=dict(stop_when_idle=False), daemon=True
+        ).start()
+    else:
+        batcher = None
+
+    server = ThreadingHTTPServer(
+        (host, port), create_handler(pipeline, ckpt_dir, batcher)
+    )
+    print(f"{Color.red}Serving {ckpt_dir} on http://{host}:{port}{Color.end}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
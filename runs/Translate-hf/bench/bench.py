@@ -0,0 +1,372 @@
+# Benchmark of the code-translation engine over a fixed filemap
+
+# Import libraries
+import os, sys, json, time, resource, platform, toml
+
+for path in os.getenv("PYMODULE_PATH").split(":"):
+    sys.path.insert(0, path)
+
+import api, neucol, engine, scheduler
+
+from typing import Optional
+import fire, transformers, torch
+
+
+class TimingStreamer(transformers.generation.BaseStreamer):
+    """
+    Streamer that records when generate emits the prompt and every new
+    token, used to split generation time into prefill and decode
+    """
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.token_times = []
+
+    def put(self, value):
+        self.token_times.append(time.perf_counter())
+
+    def end(self):
+        pass
+
+
+def peak_memory():
+    """
+    Return peak resident set size of the process and peak allocated
+    GPU memory since the last reset in megabytes
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if sys.platform == "darwin":
+        rss /= 1024
+
+    gpu = (
+        torch.cuda.max_memory_allocated() / 1024**2 if torch.cuda.is_available() else 0
+    )
+    return dict(peak_rss_mb=rss, peak_gpu_mb=gpu)
+
+
+def measure_file(model, tokenizer, conversation, max_new_tokens, prefix=None):
+    """
+    Time prefill and decode for a single conversation. Generation runs
+    through engine.generate_batch, or engine.generate_with_prefix if a
+    prefix cache is given, like single file batches in translate.py.
+    Decoding is greedy and ignores end of sequence so every file
+    produces the same number of tokens across runs.
+
+    Arguments
+    ---------
+    model          : Causal language model
+    tokenizer      : Tokenizer for the model
+    conversation   : List of chat messages
+    max_new_tokens : Integer value of generated tokens
+    prefix         : Dictionary returned by engine.create_prefix_cache
+    """
+    input_ids = torch.tensor(
+        [engine.encode(tokenizer, conversation)], device=model.device
+    )
+
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+        torch.cuda.synchronize()
+
+    start_time = time.perf_counter()
+    with torch.no_grad():
+        model(input_ids=input_ids)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    prefill_seconds = time.perf_counter() - start_time
+
+    streamer = TimingStreamer()
+    generate_kwargs = dict(
+        max_new_tokens=max_new_tokens,
+        min_new_tokens=max_new_tokens,
+        do_sample=False,
+        pad_token_id=tokenizer.pad_token_id,
+        streamer=streamer,
+    )
+    if prefix:
+        result = engine.generate_with_prefix(
+            model, tokenizer, prefix, conversation, **generate_kwargs
+        )
+    else:
+        result = engine.generate_batch(
+            model, tokenizer, [conversation], **generate_kwargs
+        )[0]
+    end_time = time.perf_counter()
+
+    # The first put is the prompt, the second is the first new token
+    output_tokens = result["output_tokens"]
+    first_token_time = streamer.token_times[1]
+    decode_seconds = end_time - first_token_time
+
+    return dict(
+        input_tokens=input_ids.shape[1],
+        output_tokens=output_tokens,
+        prefill_seconds=prefill_seconds,
+        ttft_seconds=first_token_time - streamer.start_time,
+        decode_tokens_per_second=(output_tokens - 1) / max(decode_seconds, 1e-9),
+        wall_seconds=end_time - start_time,
+        **peak_memory(),
+    )
+
+
+def measure_batched(model, tokenizer, conversations, batch_size, max_new_tokens):
+    """
+    Time the batched path of translate.py over all files, batches of
+    similar prompt length generated with engine.generate_batch
+
+    Arguments
+    ---------
+    model          : Causal language model
+    tokenizer      : Tokenizer for the model configured for padding
+    conversations  : List of conversations
+    batch_size     : Integer value of batch size
+    max_new_tokens : Integer value of generated tokens per file
+    """
+    tasks = [
+        dict(
+            conversation=conversation,
+            ntokens=engine.count_tokens(tokenizer, conversation),
+        )
+        for conversation in conversations
+    ]
+
+    start_time = time.perf_counter()
+    output_tokens = 0
+    for batch in engine.create_batches(tasks, batch_size):
+        results = engine.generate_batch(
+            model,
+            tokenizer,
+            [task["conversation"] for task in batch],
+            max_new_tokens=max_new_tokens,
+            min_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+        output_tokens += sum(result["output_tokens"] for result in results)
+    wall_seconds = time.perf_counter() - start_time
+
+    return dict(
+        batch_size=batch_size,
+        output_tokens=output_tokens,
+        tokens_per_second=output_tokens / wall_seconds,
+        wall_seconds=wall_seconds,
+    )
+
+
+def measure_continuous(
+    model, tokenizer, conversations, batch_size, max_new_tokens, max_tokens_in_flight
+):
+    """
+    Time the continuous batching path of translate.py over all files.
+    End of sequence is disabled so every file generates max_new_tokens.
+
+    Arguments
+    ---------
+    model                : Causal language model
+    tokenizer            : Tokenizer for the model
+    conversations        : List of conversations
+    batch_size           : Integer value of maximum running sequences
+    max_new_tokens       : Integer value of generated tokens per file
+    max_tokens_in_flight : Integer value of maximum reserved tokens
+    """
+    batcher = scheduler.ContinuousBatcher(model, None, batch_size, max_tokens_in_flight)
+
+    start_time = time.perf_counter()
+    futures = [
+        batcher.submit(engine.encode(tokenizer, conversation), max_new_tokens)
+        for conversation in conversations
+    ]
+    batcher.run()
+    output_tokens = sum(len(future.result()[0]) for future in futures)
+    wall_seconds = time.perf_counter() - start_time
+
+    return dict(
+        batch_size=batch_size,
+        output_tokens=output_tokens,
+        tokens_per_second=output_tokens / wall_seconds,
+        wall_seconds=wall_seconds,
+    )
+
+
+def compare_reports(report, baseline, tolerance):
+    """
+    Compare report with a baseline report. Returns a dictionary with the
+    ratio of every metric to its baseline value and the list of metrics
+    that regressed by more than tolerance.
+
+    Arguments
+    ---------
+    report    : Dictionary of benchmark results
+    baseline  : Dictionary of benchmark results from a previous run
+    tolerance : Float value of allowed relative regression
+    """
+    # Metrics where a larger value is better, all others are costs
+    higher_is_better = ["decode_tokens_per_second", "tokens_per_second"]
+
+    ratios = {}
+    regressions = []
+
+    def compare(name, value, reference):
+        if not isinstance(value, (int, float)) or not reference:
+            return
+        ratio = value / reference
+        ratios[name] = ratio
+        key = name.split(".")[-1]
+        if key in higher_is_better:
+            regressed = ratio < 1 - tolerance
+        else:
+            regressed = ratio > 1 + tolerance
+        if regressed and key not in ["input_tokens", "output_tokens"]:
+            regressions.append(name)
+
+    baseline_files = {entry["source"]: entry for entry in baseline.get("files", [])}
+    for entry in report["files"]:
+        for key, value in entry.items():
+            compare(
+                f"{entry['source']}.{key}",
+                value,
+                baseline_files.get(entry["source"], {}).get(key),
+            )
+
+    for section in ["total", "batched", "continuous"]:
+        for key, value in report.get(section, {}).items():
+            compare(f"{section}.{key}", value, baseline.get(section, {}).get(key))
+
+    return dict(ratios=ratios, regressions=regressions)
+
+
+def main(
+    filemap: str,
+    template: str,
+    ckpt_dir: Optional[str] = None,
+    max_new_tokens: int = 64,
+    batch_size: int = 4,
+    precision: Optional[str] = None,
+    prefix_cache: bool = False,
+    max_tokens_in_flight: int = 65536,
+    baseline: Optional[str] = "baseline.json",
+    report: str = "report.json",
+    tolerance: float = 0.2,
+    update_baseline: bool = False,
+):
+
+    if ckpt_dir is None:
+        ckpt_dir = os.getenv("MODEL_HOME") + os.sep + "tiny/tiny-random-llama"
+
+    device = 0 if torch.cuda.is_available() else "cpu"
+
+    start_time = time.perf_counter()
+
+    api.display_output(f'Loading "{ckpt_dir}" on {device}')
+    pipeline = engine.load_pipeline(ckpt_dir, device, precision)
+    engine.configure_padding(pipeline.tokenizer)
+    load_seconds = time.perf_counter() - start_time
+
+    mapping = neucol.create_src_mapping(filemap)
+    instructions = toml.load(template)["instructions"]
+
+    prefix = None
+    if prefix_cache:
+        prefix = engine.create_prefix_cache(
+            pipeline.model, pipeline.tokenizer, instructions
+        )
+
+    files = []
+    conversations = []
+
+    for sfile in mapping["src"]["files"]:
+        conversation = engine.create_conversation(
+            instructions, engine.read_source(sfile)
+        )
+        conversations.append(conversation)
+
+        result = measure_file(
+            pipeline.model, pipeline.tokenizer, conversation, max_new_tokens, prefix
+        )
+        result = dict(
+            source=sfile.replace(mapping["src"]["dir"] + os.sep, ""), **result
+        )
+        files.append(result)
+
+        api.display_output(
+            f"{result['source']}: prefill {result['prefill_seconds']:.3f} s, "
+            + f"TTFT {result['ttft_seconds']:.3f} s, "
+            + f"{result['decode_tokens_per_second']:.1f} tok/s"
+        )
+
+    batched = measure_batched(
+        pipeline.model, pipeline.tokenizer, conversations, batch_size, max_new_tokens
+    )
+    continuous = measure_continuous(
+        pipeline.model,
+        pipeline.tokenizer,
+        conversations,
+        batch_size,
+        max_new_tokens,
+        max_tokens_in_flight,
+    )
+
+    output_tokens = sum(result["output_tokens"] for result in files)
+    decode_seconds = sum(
+        (result["output_tokens"] - 1) / result["decode_tokens_per_second"]
+        for result in files
+    )
+
+    results = dict(
+        config=dict(
+            model=os.path.basename(ckpt_dir),
+            filemap=filemap,
+            template=template,
+            max_new_tokens=max_new_tokens,
+            batch_size=batch_size,
+            precision=precision,
+            prefix_cache=prefix_cache,
+            device=str(device),
+            machine=platform.machine(),
+            cpus=os.cpu_count(),
+            torch=torch.__version__,
+            transformers=transformers.__version__,
+        ),
+        files=files,
+        total=dict(
+            load_seconds=load_seconds,
+            prefill_seconds=sum(result["prefill_seconds"] for result in files),
+            ttft_seconds=sum(result["ttft_seconds"] for result in files) / len(files),
+            decode_tokens_per_second=(output_tokens - len(files)) / decode_seconds,
+            wall_seconds=time.perf_counter() - start_time,
+            **peak_memory(),
+        ),
+        batched=batched,
+        continuous=continuous,
+    )
+
+    if baseline and os.path.isfile(baseline) and not update_baseline:
+        with open(baseline, "r") as reference:
+            results["comparison"] = compare_reports(
+                results, json.load(reference), tolerance
+            )
+
+        for name in results["comparison"]["regressions"]:
+            api.display_output(
+                f"Regression in {name}: {results['comparison']['ratios'][name]:.2f}x baseline"
+            )
+
+    api.display_output(
+        f"Decoded {results['total']['decode_tokens_per_second']:.1f} tok/s per file, "
+        + f"{batched['tokens_per_second']:.1f} tok/s batched, "
+        + f"{continuous['tokens_per_second']:.1f} tok/s continuous, "
+        + f"peak RSS {results['total']['peak_rss_mb']:.0f} MB in "
+        + f"{results['total']['wall_seconds']:.1f} s"
+    )
+
+    with open(report, "w") as outfile:
+        json.dump(results, outfile, indent=2)
+
+    if update_baseline and baseline:
+        with open(baseline, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+        api.display_output(f'Updated baseline "{baseline}"')
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
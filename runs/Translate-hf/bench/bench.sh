@@ -0,0 +1,14 @@
+# Shell script for benchmarking the code-translation engine. This
+# script executes job.target defined in Jobfile.
+
+# Translate the fixtures in this directory with the engine modules
+# from latest, so the benchmark does not depend on an MCFM checkout
+export PYMODULE_PATH="$PWD/../latest:$PYMODULE_PATH"
+export MCFM_HOME="$PWD/fixtures"
+
+# Execute python command and deploy job.target. Set BENCH_CKPT to
+# benchmark another checkpoint than the tiny model in models/tiny
+python3 $JobWorkDir/job.target --filemap filemap.toml \
+                               --template ../latest/templates/funcs_updated.toml \
+                               --baseline baseline.json \
+                               ${BENCH_CKPT:+--ckpt_dir $BENCH_CKPT}
@@ -0,0 +1,11 @@
+! Module of constants
+module constants
+  use types
+  implicit none
+  real(dp), parameter :: pi = 3.14159265358979_dp
+  real(dp), parameter :: twopi = 2._dp*pi
+  integer, parameter :: mxpart = 14
+  complex(dp), parameter :: im = (0._dp, 1._dp)
+  real(dp), save :: scale, musq
+  real(dp), dimension(mxpart, 4) :: pmom
+end module constants
@@ -0,0 +1,4 @@
+module types
+  implicit none
+  integer, parameter :: dp = selected_real_kind(15)
+end module types
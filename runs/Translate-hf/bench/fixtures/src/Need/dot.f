@@ -0,0 +1,17 @@
+!  Copyright (C) 2019-2022, respective authors of MCFM.
+!
+!  This program is free software: you can redistribute it and/or modify it under
+!  the terms of the GNU General Public License
+
+      function dot(p,i,j)
+      implicit none
+      include 'types.f'
+      real(dp):: dot
+c---returns the dot product of the two momenta p(i,mu) and p(j,mu)
+      include 'mxpart.f'
+      integer:: i,j
+      real(dp):: p(mxpart,4)
+      dot=p(i,4)*p(j,4)-p(i,1)*p(j,1)
+     &   -p(i,2)*p(j,2)-p(i,3)*p(j,3)  ! trailing comment
+      return
+      end
@@ -0,0 +1,24 @@
+      subroutine fillSij(p)
+      use constants
+      implicit none
+c     fill the invariants
+      real(dp):: p(mxpart,4), s(mxpart,mxpart)
+      integer:: i,j
+      do i=1,5
+        do j=1,5
+          s(i,j)=2._dp*(p(i,4)*p(j,4)-p(i,1)*p(j,1)
+     &      -p(i,2)*p(j,2)-p(i,3)*p(j,3))
+        enddo
+      enddo
+      write(6,*) 'fillSij: ! not a comment', twopi
+      return
+      end
+
+      function sdot(p,i,j)
+      use constants
+      implicit none
+      real(dp):: sdot, p(mxpart,4)
+      integer:: i,j
+      sdot = p(i,4)*p(j,4)
+      return
+      end
@@ -0,0 +1,7 @@
+      subroutine helfill(hel)
+      use constants
+      implicit none
+      integer:: hel(5)
+      hel(1) = 1
+      return
+      end
@@ -0,0 +1,98 @@
+# Module for sizing generation budgets from observed output ratios
+
+import os, json, hashlib, math
+
+
+def create_key(ckpt_dir, instructions):
+    """
+    Compute hash of the model and template that output ratios belong to
+
+    Arguments
+    ---------
+    ckpt_dir     : String value of checkpoint directory
+    instructions : List of chat messages loaded from template
+    """
+    content = json.dumps(
+        dict(model=os.path.realpath(ckpt_dir), instructions=instructions),
+        sort_keys=True,
+    )
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def size_budget(source_tokens, ratio, margin, max_new_tokens, min_new_tokens=64):
+    """
+    Return number of new tokens to generate for a chunk, the expected
+    output length times a safety margin clipped to the global limit
+
+    Arguments
+    ---------
+    source_tokens  : Integer value of source code tokens in the chunk
+    ratio          : Float value of expected output to input token ratio
+    margin         : Float value multiplying the expected output length
+    max_new_tokens : Integer value of maximum generated tokens
+    min_new_tokens : Integer value of minimum generated tokens
+    """
+    budget = math.ceil(source_tokens * ratio * margin)
+    return min(max(budget, min_new_tokens), max_new_tokens)
+
+
+class RatioStore:
+    """
+    Output to input token ratios observed in previous runs, one entry
+    per model and template. Only chunks that ended with end of sequence
+    or the closing code fence are counted, truncated outputs would bias
+    the ratio low.
+
+    Arguments
+    ---------
+    path : String value of JSON file holding the ratios
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+
+        if os.path.isfile(path):
+            with open(path, "r") as ratios:
+                self.entries = json.load(ratios)
+
+    def ratio(self, key, default):
+        """
+        Return observed ratio for key or default if nothing was observed
+
+        Arguments
+        ---------
+        key     : String value of model and template hash
+        default : Float value returned without observations
+        """
+        entry = self.entries.get(key)
+        if not entry or entry["input_tokens"] == 0:
+            return default
+        return entry["output_tokens"] / entry["input_tokens"]
+
+    def update(self, key, input_tokens, output_tokens, chunks, **fields):
+        """
+        Add observed tokens to the entry for key and write the file
+
+        Arguments
+        ---------
+        key           : String value of model and template hash
+        input_tokens  : Integer value of source code tokens
+        output_tokens : Integer value of generated tokens
+        chunks        : Integer value of observed chunks
+        fields        : Descriptive values such as model and template
+        """
+        entry = self.entries.setdefault(
+            key, dict(input_tokens=0, output_tokens=0, chunks=0)
+        )
+        entry.update(fields)
+        entry["input_tokens"] += input_tokens
+        entry["output_tokens"] += output_tokens
+        entry["chunks"] += chunks
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + ".tmp", "w") as ratios:
+            json.dump(self.entries, ratios, indent=2)
+        os.replace(self.path + ".tmp", self.path)
@@ -0,0 +1,147 @@
+# Module for caching LLM outputs on disk by content hash
+
+import os, json, time, hashlib, tempfile
+
+
+def create_key(ckpt_dir, instructions, params, source_code, context=None):
+    """
+    Compute hash of everything that determines the generated text
+
+    Arguments
+    ---------
+    ckpt_dir     : String value of checkpoint directory
+    instructions : List of chat messages loaded from template
+    params       : Dictionary of generation parameters
+    source_code  : List of source code lines after stripping comments
+    context      : List of prompt lines placed before the source code
+    """
+    fields = dict(
+        model=os.path.realpath(ckpt_dir),
+        instructions=instructions,
+        params=params,
+        source="".join(source_code),
+    )
+    # Keys of prompts without context stay valid
+    if context:
+        fields["context"] = context
+    content = json.dumps(fields, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class TranslationCache:
+    """
+    Content-addressed store of generated text. Each entry is a JSON file
+    named after the hash of everything that determines the output.
+    Entries are evicted least recently used first once the directory
+    grows beyond the size limit.
+
+    Arguments
+    ---------
+    cache_dir : String value of cache directory
+    max_size  : Integer value of maximum cache size in bytes
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        """
+        Return cached entry for key or None. A hit refreshes the
+        modification time used for eviction.
+
+        Arguments
+        ---------
+        key : String value of cache key
+        """
+        try:
+            with open(self.path(key), "r") as entry:
+                value = json.load(entry)
+            os.utime(self.path(key))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return value
+
+    def put(self, key, output, metadata):
+        """
+        Store generated text with metadata and evict old entries
+
+        Arguments
+        ---------
+        key      : String value of cache key
+        output   : String value of generated text
+        metadata : Dictionary of information about the entry
+        """
+        handle, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(handle, "w") as entry:
+            json.dump(dict(output=output, metadata=metadata, time=time.time()), entry)
+        os.replace(tmp, self.path(key))
+        self.evict()
+
+    def remove(self, key):
+        """
+        Remove entry for key, for example when its output is invalid
+
+        Arguments
+        ---------
+        key : String value of cache key
+        """
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def remove_sources(self, sources):
+        """
+        Remove all entries generated from the given source files and
+        return the number of removed entries. Entries of every model,
+        template and parameter set are removed.
+
+        Arguments
+        ---------
+        sources : List of source file paths
+        """
+        sources = set(sources)
+        removed = 0
+
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.cache_dir, name), "r") as entry:
+                    metadata = json.load(entry).get("metadata") or {}
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            if metadata.get("source") in sources:
+                self.remove(name[: -len(".json")])
+                removed += 1
+
+        return removed
+
+    def evict(self):
+        """
+        Remove least recently used entries until cache fits max_size
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json"):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total_size = sum(entry[1] for entry in entries)
+
+        for mtime, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
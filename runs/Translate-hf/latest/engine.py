@@ -0,0 +1,599 @@
+# Module for preparing and batching code conversion requests
+
+import os, sys, copy, json, time, urllib.request
+
+for path in os.getenv("PYMODULE_PATH").split(":"):
+    sys.path.insert(0, path)
+
+import api, lexer, stopping
+
+import torch, transformers
+
+precisions = dict(fp32=torch.float32, fp16=torch.float16, bf16=torch.bfloat16)
+
+# Checkpoints under MODEL_HOME in the order of the model selection menu
+checkpoints = {
+    "mistral-7b": "mistral/Mistral-7B-Instruct-v0.1",
+    "codellama-7b": "codellama/CodeLlama-7b-Instruct-hf",
+    "gemma-7b": "google/gemma-7b-it",
+    "tiny-random": "tiny/tiny-random-llama",
+}
+
+
+def read_source(sfile):
+    """
+    Read source file and normalize it for the prompt by removing
+    comments, blank lines and redundant whitespace
+
+    Arguments
+    ---------
+    sfile : String value of source file path
+    """
+    with open(sfile, "r") as source:
+        return lexer.normalize_source(source.readlines(), sfile)
+
+
+def create_conversation(instructions, source_code, context=None):
+    """
+    Create chat conversation for a single source file by appending
+    the source code to the last message of the template
+
+    Arguments
+    ---------
+    instructions : List of chat messages loaded from template
+    source_code  : List of source code lines
+    context      : List of declaration lines shown in a separate block
+                   before the source code
+    """
+    conversation = copy.deepcopy(instructions)
+    if context:
+        conversation[-1]["content"] += (
+            "\nDeclarations from the used modules, for reference only and "
+            + "not to be converted:\n```\n"
+            + "\n".join(context)
+            + "\n```\nCode to convert:"
+        )
+    conversation[-1]["content"] += "\n" + "".join(source_code)
+    return conversation
+
+
+def encode(tokenizer, conversation):
+    """
+    Apply chat template and return prompt token ids for a conversation
+
+    Arguments
+    ---------
+    tokenizer    : Tokenizer for the model
+    conversation : List of chat messages
+    """
+    prompt = tokenizer.apply_chat_template(
+        conversation, tokenize=False, add_generation_prompt=True
+    )
+    return tokenizer(prompt, add_special_tokens=False)["input_ids"]
+
+
+def create_result(tokenizer, output_ids, eos_token_id=None, stop_reason=None, **fields):
+    """
+    Decode generated token ids up to the first end of sequence token and
+    return a dictionary with the output text, the number of generated
+    tokens and the stop reason, which is "eos" if the model finished and
+    "length" if it ran out of tokens
+
+    Arguments
+    ---------
+    tokenizer    : Tokenizer for the model
+    output_ids   : List or tensor of generated token ids without prompt
+    eos_token_id : Integer value or list of end of sequence tokens
+    stop_reason  : String value of stop reason from early stopping,
+                   replaces "eos" and "length" if set
+    fields       : Additional values stored in the result
+    """
+    if eos_token_id is None:
+        eos_token_id = tokenizer.eos_token_id
+    if not isinstance(eos_token_id, (list, tuple)):
+        eos_token_id = [eos_token_id]
+
+    output_ids = [int(token) for token in output_ids]
+    finish_reason = "length"
+
+    # Sequences stopped early are padded, which may use the eos token
+    for index, token in enumerate(output_ids):
+        if token in eos_token_id:
+            output_ids = output_ids[:index]
+            finish_reason = "eos"
+            break
+
+    return dict(
+        output=tokenizer.decode(output_ids, skip_special_tokens=True),
+        output_tokens=len(output_ids),
+        stop_reason=stop_reason or finish_reason,
+        **fields,
+    )
+
+
+def early_stopping(tokenizer, prompt_length, batch_size, early_stop, kwargs):
+    """
+    Add stopping criteria for the early_stop options to the keyword
+    arguments of model.generate and return the stop reason of every
+    sequence, which is filled in during generation
+
+    Arguments
+    ---------
+    tokenizer     : Tokenizer for the model
+    prompt_length : Integer value of padded prompt tokens
+    batch_size    : Integer value of sequences in the batch
+    early_stop    : Dictionary of StopCheck options, disabled if None
+    kwargs        : Keyword arguments passed to model.generate
+    """
+    if not early_stop:
+        return [None] * batch_size
+
+    criteria = stopping.EarlyStoppingCriteria(
+        tokenizer, prompt_length, batch_size, kwargs.get("eos_token_id"), **early_stop
+    )
+    kwargs["stopping_criteria"] = transformers.StoppingCriteriaList(
+        list(kwargs.get("stopping_criteria") or []) + [criteria]
+    )
+    return criteria.reasons
+
+
+def count_tokens(tokenizer, conversation):
+    """
+    Count prompt tokens for a chat conversation
+
+    Arguments
+    ---------
+    tokenizer    : Tokenizer for the model
+    conversation : List of chat messages
+    """
+    return len(encode(tokenizer, conversation))
+
+
+def configure_padding(tokenizer):
+    """
+    Configure tokenizer for batched generation. Decoder-only models
+    need left padding, and most instruct checkpoints do not define a
+    pad token so we reuse the end of sequence token.
+
+    Arguments
+    ---------
+    tokenizer : Tokenizer for the model
+    """
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+    tokenizer.padding_side = "left"
+
+
+def load_model(ckpt_dir, device, precision=None):
+    """
+    Load causal language model with weights placed directly on the
+    device. Safetensors checkpoints are memory mapped, so host memory
+    peaks near the model size instead of holding a second copy. The
+    int8 precision quantizes linear layer weights with bitsandbytes on
+    GPU and with dynamic quantization on CPU.
+
+    Arguments
+    ---------
+    ckpt_dir  : String value of checkpoint directory
+    device    : Device index or "cpu"
+    precision : String value of fp32, fp16, bf16 or int8. Defaults to
+                fp32 on CPU and fp16 otherwise
+    """
+    if precision is None:
+        precision = "fp32" if device == "cpu" else "fp16"
+
+    if precision not in list(precisions) + ["int8"]:
+        api.display_output(f"Precision {precision} not defined")
+        raise ValueError
+
+    kwargs = dict(
+        low_cpu_mem_usage=True,
+        use_safetensors=any(
+            name.endswith(".safetensors") for name in os.listdir(ckpt_dir)
+        ),
+        device_map={"": device},
+    )
+
+    if precision != "int8":
+        kwargs["torch_dtype"] = precisions[precision]
+    elif device != "cpu":
+        kwargs["torch_dtype"] = torch.float16
+        kwargs["quantization_config"] = transformers.BitsAndBytesConfig(
+            load_in_8bit=True
+        )
+
+    model = transformers.AutoModelForCausalLM.from_pretrained(ckpt_dir, **kwargs)
+
+    if precision == "int8" and device == "cpu":
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+
+    return model
+
+
+def load_pipeline(ckpt_dir, device, precision=None):
+    """
+    Load text generation pipeline for a checkpoint with load_model
+
+    Arguments
+    ---------
+    ckpt_dir  : String value of checkpoint directory
+    device    : Device index or "cpu"
+    precision : String value of fp32, fp16, bf16 or int8
+    """
+    return transformers.pipeline(
+        "text-generation",
+        model=load_model(ckpt_dir, device, precision),
+        tokenizer=transformers.AutoTokenizer.from_pretrained(ckpt_dir),
+    )
+
+
+def generate_batch(model, tokenizer, conversations, early_stop=None, **kwargs):
+    """
+    Generate replies for a batch of conversations with left padding and
+    return a result from create_result for each conversation
+
+    Arguments
+    ---------
+    model         : Causal language model
+    tokenizer     : Tokenizer for the model configured for padding
+    conversations : List of conversations
+    early_stop    : Dictionary of StopCheck options, disabled if None
+    kwargs        : Keyword arguments passed to model.generate
+    """
+    inputs = tokenizer.pad(
+        dict(
+            input_ids=[
+                encode(tokenizer, conversation) for conversation in conversations
+            ]
+        ),
+        return_tensors="pt",
+    ).to(model.device)
+
+    stop_reasons = early_stopping(
+        tokenizer, inputs["input_ids"].shape[1], len(conversations), early_stop, kwargs
+    )
+    outputs = model.generate(**inputs, **kwargs)
+
+    return [
+        create_result(tokenizer, output_ids, kwargs.get("eos_token_id"), stop_reason)
+        for output_ids, stop_reason in zip(
+            outputs[:, inputs["input_ids"].shape[1] :], stop_reasons
+        )
+    ]
+
+
+def create_batches(tasks, batch_size):
+    """
+    Group tasks into batches of similar prompt length to minimize
+    padding. Tasks are expected to have "ntokens" set.
+
+    Arguments
+    ---------
+    tasks      : List of task dictionaries
+    batch_size : Integer value of maximum batch size
+    """
+    tasks = sorted(tasks, key=lambda task: task["ntokens"], reverse=True)
+    return [tasks[i : i + batch_size] for i in range(0, len(tasks), batch_size)]
+
+
+def chunk_budget(config, template_tokens, max_new_tokens, output_ratio=1.5):
+    """
+    Compute the largest number of source tokens per chunk such that the
+    template, the chunk and its translation fit in the context window
+    and the translation fits in max_new_tokens
+
+    Arguments
+    ---------
+    config          : Model configuration
+    template_tokens : Integer value of prompt tokens without source code
+    max_new_tokens  : Integer value of maximum generated tokens
+    output_ratio    : Float value of expected output to input token ratio
+    """
+    context = getattr(config, "max_position_embeddings", None) or 4096
+    context = min(context, getattr(config, "sliding_window", None) or context)
+
+    budget = min(
+        (context - template_tokens) / (1 + output_ratio),
+        max_new_tokens / output_ratio,
+    )
+
+    if budget < 1:
+        api.display_output(
+            f"Template with {template_tokens} tokens leaves no room for source code"
+        )
+        raise ValueError
+
+    return int(budget)
+
+
+def create_label(task, src_dir):
+    """
+    Create progress bar label for a task with chunk index when the
+    source file is split into chunks
+
+    Arguments
+    ---------
+    task    : Task dictionary with job and chunk index
+    src_dir : String value of source directory
+    """
+    label = task["job"]["source"].replace(src_dir + os.sep, "")
+    if len(task["job"]["outputs"]) > 1:
+        label += f" [{task['index'] + 1}/{len(task['job']['outputs'])}]"
+    return label
+
+
+def create_prefix_cache(model, tokenizer, instructions):
+    """
+    Prefill the fixed part of the template once and keep its key/value
+    cache. The prefix is everything in the chat prompt before the point
+    where source code is appended to the last message.
+
+    Arguments
+    ---------
+    model        : Causal language model
+    tokenizer    : Tokenizer for the model
+    instructions : List of chat messages loaded from template
+    """
+    marker = "<<NEUCOL-SOURCE>>"
+    prompt = tokenizer.apply_chat_template(
+        create_conversation(instructions, [marker]),
+        tokenize=False,
+        add_generation_prompt=True,
+    )
+    input_ids = tokenizer(
+        prompt[: prompt.index(marker)], add_special_tokens=False, return_tensors="pt"
+    ).input_ids.to(model.device)
+
+    cache = transformers.DynamicCache()
+    with torch.no_grad():
+        model(input_ids=input_ids, past_key_values=cache, use_cache=True)
+
+    return dict(input_ids=input_ids[0], cache=cache)
+
+
+def generate_with_prefix(
+    model, tokenizer, prefix, conversation, early_stop=None, **kwargs
+):
+    """
+    Generate reply for a single conversation starting from a copy of
+    the prefilled template cache. Only tokens after the shared prefix
+    are prefilled.
+
+    Arguments
+    ---------
+    model        : Causal language model
+    tokenizer    : Tokenizer for the model
+    prefix       : Dictionary returned by create_prefix_cache
+    conversation : List of chat messages
+    early_stop   : Dictionary of StopCheck options, disabled if None
+    kwargs       : Keyword arguments passed to model.generate
+    """
+    prompt = tokenizer.apply_chat_template(
+        conversation, tokenize=False, add_generation_prompt=True
+    )
+    input_ids = tokenizer(
+        prompt, add_special_tokens=False, return_tensors="pt"
+    ).input_ids.to(model.device)
+
+    # Tokens at the boundary between template and source may merge
+    # differently, so reuse only the longest common prefix and leave at
+    # least one token for generate to process.
+    num_cached = min(len(prefix["input_ids"]), input_ids.shape[1] - 1)
+    mismatch = (
+        (input_ids[0, :num_cached] != prefix["input_ids"][:num_cached])
+        .nonzero()
+        .flatten()
+    )
+    if len(mismatch) > 0:
+        num_cached = int(mismatch[0])
+
+    cache = copy.deepcopy(prefix["cache"])
+    cache.crop(num_cached)
+
+    stop_reasons = early_stopping(tokenizer, input_ids.shape[1], 1, early_stop, kwargs)
+    outputs = model.generate(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        past_key_values=cache,
+        **kwargs,
+    )
+
+    return create_result(
+        tokenizer,
+        outputs[0, input_ids.shape[1] :],
+        kwargs.get("eos_token_id"),
+        stop_reasons[0],
+    )
+
+
+def generate_speculative(model, tokenizer, conversation, early_stop=None, **kwargs):
+    """
+    Generate reply for a single conversation with greedy assisted
+    decoding. Candidate tokens come from a draft model or from n-grams
+    of the prompt, depending on kwargs, and the target model verifies
+    them in one forward pass. The result from create_result also holds
+    the number of drafted and accepted candidate tokens.
+
+    Arguments
+    ---------
+    model        : Causal language model
+    tokenizer    : Tokenizer for the model
+    conversation : List of chat messages
+    early_stop   : Dictionary of StopCheck options, disabled if None
+    kwargs       : Keyword arguments passed to model.generate with
+                   assistant_model or prompt_lookup_num_tokens set
+    """
+    input_ids = torch.tensor([encode(tokenizer, conversation)], device=model.device)
+    stop_reasons = early_stopping(tokenizer, input_ids.shape[1], 1, early_stop, kwargs)
+
+    # Every verification pass runs the target model on the candidates
+    # plus one token, and the first pass also prefills the prompt
+    lengths = []
+    hook = model.register_forward_pre_hook(
+        lambda module, args, inputs: lengths.append(inputs["input_ids"].shape[1]),
+        with_kwargs=True,
+    )
+    try:
+        outputs = model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            do_sample=False,
+            **kwargs,
+        )
+    finally:
+        hook.remove()
+
+    output_ids = outputs[0, input_ids.shape[1] :]
+    drafted = sum(lengths) - input_ids.shape[1] - len(lengths) + 1
+    accepted = len(output_ids) - len(lengths)
+
+    return create_result(
+        tokenizer,
+        output_ids,
+        kwargs.get("eos_token_id"),
+        stop_reasons[0],
+        drafted=drafted,
+        accepted=max(accepted, 0),
+    )
+
+
+def write_header(destination, tfile, instructions):
+    """
+    Write template instructions as a comment header for the target file
+
+    Arguments
+    ---------
+    destination  : File object opened for writing
+    tfile        : String value of target file path
+    instructions : List of chat messages loaded from template
+    """
+    if tfile.endswith((".hpp", ".cpp")):
+        comment_start = "/*"
+        comment_contd = " *"
+        comment_end = "*/"
+    elif tfile.endswith(".f90"):
+        comment_start = "!!"
+        comment_contd = "!!"
+        comment_end = ""
+    else:
+        api.display_output(f"Cannot write to destination file: {tfile}")
+        raise ValueError
+
+    destination.write(f"{comment_start} LLM INSTRUCTIONS START\n")
+    for line in instructions[0]["content"].split("\n"):
+        destination.write(f"{comment_contd} {line}\n")
+    destination.write(f"{comment_contd} LLM INSTRUCTIONS END {comment_end}\n\n")
+
+
+def write_target(tfile, instructions, output):
+    """
+    Write LLM output to target file with instructions as a header. The
+    file is written to a temporary path first and renamed so a target
+    is never left half-written.
+
+    Arguments
+    ---------
+    tfile        : String value of target file path
+    instructions : List of chat messages loaded from template
+    output       : String value of generated text
+    """
+    with open(tfile + ".tmp", "w") as destination:
+        write_header(destination, tfile, instructions)
+        destination.write(output)
+    os.replace(tfile + ".tmp", tfile)
+
+
+class FileStreamer(transformers.TextStreamer):
+    """
+    Token streamer that appends decoded text to a ".partial" sidecar of
+    the target file as it is generated and reports decode speed on the
+    progress bar. Chunks of the same target append to the sidecar, which
+    replaces the target once the last chunk is generated.
+
+    Arguments
+    ---------
+    tokenizer    : Tokenizer for the model
+    tfile        : String value of target file path
+    instructions : List of chat messages loaded from template
+    bar          : Progress bar from alive_bar
+    label        : String value shown on the progress bar
+    first        : Boolean for the first chunk of the target file
+    last         : Boolean for the last chunk of the target file
+    """
+
+    def __init__(
+        self, tokenizer, tfile, instructions, bar, label, first=True, last=True
+    ):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.tfile = tfile
+        self.partial = tfile + ".partial"
+        self.bar = bar
+        self.label = label
+        self.last = last
+        self.num_tokens = 0
+        self.start_time = None
+
+        if first:
+            self.destination = open(self.partial, "w")
+            write_header(self.destination, tfile, instructions)
+        else:
+            self.destination = open(self.partial, "a")
+            self.destination.write("\n")
+        self.destination.flush()
+
+    def put(self, value):
+        if not self.next_tokens_are_prompt:
+            if self.start_time is None:
+                self.start_time = time.time()
+            self.num_tokens += value.numel()
+            rate = self.num_tokens / max(time.time() - self.start_time, 1e-6)
+            self.bar.text(f"{self.label} {rate:.1f} tok/s")
+        super().put(value)
+
+    def on_finalized_text(self, text, stream_end=False):
+        self.destination.write(text)
+        self.destination.flush()
+        if stream_end:
+            self.destination.close()
+            if self.last:
+                os.replace(self.partial, self.tfile)
+
+
+class RemotePipeline:
+    """
+    Client for the inference server in runs/Server-hf that generates
+    results in the format of generate_batch. The tokenizer is loaded
+    locally from the checkpoint reported by the server, which does not
+    load weights.
+
+    Arguments
+    ---------
+    url : String value of server address like http://127.0.0.1:8000
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+        with urllib.request.urlopen(self.url + "/health") as response:
+            self.ckpt_dir = json.load(response)["ckpt_dir"]
+
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(self.ckpt_dir)
+
+    def generate(self, conversations, **kwargs):
+        if "streamer" in kwargs:
+            api.display_output("Streaming is not supported through the server")
+            raise NotImplementedError
+
+        request = urllib.request.Request(
+            self.url + "/generate",
+            data=json.dumps(dict(conversations=conversations, **kwargs)).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+
+        try:
+            with urllib.request.urlopen(request) as response:
+                return json.load(response)["results"]
+        except urllib.error.HTTPError as error:
+            raise RuntimeError(json.load(error)["error"])
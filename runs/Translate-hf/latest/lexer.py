@@ -0,0 +1,552 @@
+# Module for lexical handling of Fortran source code
+
+import os, re
+
+unit_start = re.compile(
+    r"^\s*((recursive|pure|elemental|impure)\s+)*"
+    + r"((integer|real|double\s*precision|complex|logical|character|type\s*\([^)]*\))"
+    + r"(\s*\([^)]*\)|\s*\*\s*\d+)?\s+)?"
+    + r"(subroutine|function|program|module|block\s*data)\s+(?!procedure\b)\w+",
+    re.IGNORECASE,
+)
+
+module_statement = re.compile(
+    r"^\s*module\s+(?!procedure\b)(\w+)\s*(!.*)?$", re.IGNORECASE
+)
+
+use_statement = re.compile(
+    r"^\s*use\s*(,\s*(non_)?intrinsic\s*)?(::)?\s*(\w+)", re.IGNORECASE
+)
+
+declaration_statement = re.compile(
+    r"^\s*(?P<type>(integer|real|double\s*precision|complex|logical|character)"
+    + r"(\s*\([^)]*\)|\s*\*\s*\d+)?|type\s*\(\s*\w+\s*\))"
+    + r"\s*(?P<attributes>,[^:]*)?::(?P<entities>.*)$",
+    re.IGNORECASE,
+)
+
+type_statement = re.compile(r"^\s*type\s*(,[^:]*)?(::)?\s*(\w+)\s*$", re.IGNORECASE)
+
+raw_string = re.compile(r'R"([^()\\\s]{0,16})\(')
+
+unit_end = re.compile(
+    r"^\s*end(\s*(subroutine|function|program|module|block\s*data)(\s+\w+)?)?\s*(!.*)?$",
+    re.IGNORECASE,
+)
+
+
+def is_fixed_form(sfile):
+    """
+    Check if source file uses fixed-form Fortran based on extension
+
+    Arguments
+    ---------
+    sfile : String value of source file path
+    """
+    return os.path.splitext(sfile)[1].lower() in [".f", ".for", ".ftn", ".f77"]
+
+
+def is_cpp(sfile):
+    """
+    Check if source file is C or C++ based on extension
+
+    Arguments
+    ---------
+    sfile : String value of source file path
+    """
+    return os.path.splitext(sfile)[1].lower() in [
+        ".c",
+        ".cc",
+        ".cpp",
+        ".cxx",
+        ".h",
+        ".hh",
+        ".hpp",
+        ".hxx",
+    ]
+
+
+def is_continuation(line, fixed_form):
+    """
+    Check if a fixed-form line continues the previous statement. Free
+    form continuation is marked at the end of the previous line instead.
+
+    Arguments
+    ---------
+    line       : String value of source line
+    fixed_form : Boolean for fixed-form source
+    """
+    return (
+        fixed_form
+        and len(line) > 6
+        and line[:5].strip() == ""
+        and "\t" not in line[:5]
+        and line[5] not in " 0"
+    )
+
+
+def split_statements(lines, fixed_form):
+    """
+    Group source lines into statements so that continuation lines stay
+    with the line they continue
+
+    Arguments
+    ---------
+    lines      : List of source lines
+    fixed_form : Boolean for fixed-form source
+    """
+    statements = []
+    continued = False
+
+    for line in lines:
+        if statements and (continued or is_continuation(line, fixed_form)):
+            statements[-1].append(line)
+        else:
+            statements.append([line])
+
+        if not fixed_form and line.strip():
+            continued = line.split("!")[0].rstrip().endswith("&")
+
+    return statements
+
+
+def split_units(lines, fixed_form):
+    """
+    Split source lines into top-level program units (subroutine,
+    function, module, program). Lines before a unit, such as comments,
+    belong to that unit and trailing lines belong to the last unit.
+
+    Arguments
+    ---------
+    lines      : List of source lines
+    fixed_form : Boolean for fixed-form source
+    """
+    units = [[]]
+    depth = 0
+
+    for statement in split_statements(lines, fixed_form):
+        units[-1].extend(statement)
+
+        if unit_start.match(statement[0]):
+            depth += 1
+        elif unit_end.match(statement[0]) and depth > 0:
+            depth -= 1
+            if depth == 0:
+                units.append([])
+
+    if len(units) > 1 and not "".join(units[-1]).strip():
+        units[-2].extend(units.pop())
+
+    return units
+
+
+def create_chunks(lines, fixed_form, count_tokens, budget):
+    """
+    Pack source lines into chunks that fit a token budget. Chunks are
+    built from whole program units, and a unit that alone exceeds the
+    budget is split between statements.
+
+    Arguments
+    ---------
+    lines        : List of source lines
+    fixed_form   : Boolean for fixed-form source
+    count_tokens : Function returning token count for a list of lines
+    budget       : Integer value of maximum tokens per chunk
+    """
+    pieces = []
+    for unit in split_units(lines, fixed_form):
+        if count_tokens(unit) <= budget:
+            pieces.append(unit)
+        else:
+            pieces.extend(split_statements(unit, fixed_form))
+
+    chunks = [[]]
+    chunk_tokens = 0
+
+    for piece in pieces:
+        piece_tokens = count_tokens(piece)
+        if chunks[-1] and chunk_tokens + piece_tokens > budget:
+            chunks.append([])
+            chunk_tokens = 0
+        chunks[-1].extend(piece)
+        chunk_tokens += piece_tokens
+
+    return chunks
+
+
+def scan_modules(lines):
+    """
+    Find modules declared and used in source lines. Module names are
+    returned in lower case since Fortran is case insensitive.
+
+    Arguments
+    ---------
+    lines : List of source lines
+    """
+    declared = set()
+    used = set()
+
+    for line in lines:
+        match = module_statement.match(line)
+        if match:
+            declared.add(match.group(1).lower())
+            continue
+        match = use_statement.match(line)
+        if match:
+            used.add(match.group(4).lower())
+
+    return declared, used
+
+
+def split_top_level(text):
+    """
+    Split text at commas outside of parentheses and string literals
+
+    Arguments
+    ---------
+    text : String value of comma separated list
+    """
+    parts = [""]
+    depth = 0
+    quote = None
+
+    for char in text:
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+        elif char == "," and depth == 0:
+            parts.append("")
+            continue
+        parts[-1] += char
+
+    return [part.strip() for part in parts if part.strip()]
+
+
+def parse_entity(text):
+    """
+    Split an entity of a type declaration into its name, dimensions and
+    initial value
+
+    Arguments
+    ---------
+    text : String value of entity like "p(mxpart, 4)" or "pi = 3.14_dp"
+    """
+    match = re.match(r"\s*(\w+)\s*", text)
+    name, rest = match.group(1), text[match.end() :]
+
+    dimension = None
+    if rest.startswith("("):
+        depth = 0
+        for index, char in enumerate(rest):
+            depth += {"(": 1, ")": -1}.get(char, 0)
+            if depth == 0:
+                dimension, rest = rest[1:index], rest[index + 1 :].strip()
+                break
+
+    value = None
+    if rest.startswith("=>"):
+        value = rest[2:].strip()
+    elif rest.startswith("="):
+        value = rest[1:].strip()
+
+    return name, dimension, value
+
+
+def scan_declarations(lines):
+    """
+    Find module variables, parameters and derived types declared in the
+    specification part of Fortran modules. Every symbol keeps the
+    declaration statement that declares it alone. Names are returned in
+    lower case since Fortran is case insensitive.
+
+    Arguments
+    ---------
+    lines : List of statements from normalize_fortran
+    """
+    modules = {}
+    module = None
+    block = None
+
+    for line in lines:
+        statement = line.strip()
+        lower = statement.lower()
+
+        match = module_statement.match(statement)
+        if match:
+            module = modules.setdefault(
+                match.group(1).lower(),
+                dict(name=match.group(1), uses=[], symbols={}),
+            )
+            continue
+
+        if module is None:
+            continue
+
+        # Interface bodies and procedures are not part of the declarations
+        if re.match(r"(abstract\s+)?interface\b", lower):
+            block = "interface"
+        elif block == "interface":
+            block = None if re.match(r"end\s*interface\b", lower) else block
+        elif re.match(r"contains\b", lower) or unit_end.match(statement):
+            module = None
+        elif block is not None:
+            block["declaration"] += "\n" + statement
+            if re.match(r"end\s*type\b", lower):
+                block = None
+        elif type_statement.match(statement):
+            name = type_statement.match(statement).group(3)
+            block = module["symbols"][name.lower()] = dict(
+                name=name,
+                kind="type",
+                type=None,
+                attributes=[],
+                dimension=None,
+                value=None,
+                declaration=statement,
+            )
+        elif use_statement.match(statement):
+            module["uses"].append(use_statement.match(statement).group(4).lower())
+        elif declaration_statement.match(statement):
+            match = declaration_statement.match(statement)
+            type_spec = re.sub(r"\s+", "", match.group("type")).lower()
+            type_spec = type_spec.replace("doubleprecision", "double precision")
+            attributes = split_top_level((match.group("attributes") or "")[1:])
+            dimensions = [
+                attribute[attribute.index("(") + 1 : attribute.rindex(")")]
+                for attribute in attributes
+                if attribute.lower().startswith("dimension")
+            ]
+
+            for entity in split_top_level(match.group("entities")):
+                name, dimension, value = parse_entity(entity)
+                parameter = any(
+                    attribute.lower() == "parameter" for attribute in attributes
+                )
+                module["symbols"][name.lower()] = dict(
+                    name=name,
+                    kind="parameter" if parameter else "variable",
+                    type=type_spec,
+                    attributes=[
+                        attribute.lower()
+                        for attribute in attributes
+                        if not attribute.lower().startswith("dimension")
+                    ],
+                    dimension=dimension or (dimensions[0] if dimensions else None),
+                    value=value,
+                    declaration=match.group("type")
+                    + "".join(f", {attribute}" for attribute in attributes)
+                    + f" :: {entity}",
+                )
+
+    return modules
+
+
+def scan_identifiers(lines):
+    """
+    Return set of names referenced in Fortran statements, in lower case
+    and without the contents of string literals
+
+    Arguments
+    ---------
+    lines : List of statements from normalize_fortran
+    """
+    names = set()
+    for line in lines:
+        code = re.sub(r"'[^']*'|\"[^\"]*\"", " ", line)
+        names.update(name.lower() for name in re.findall(r"[A-Za-z]\w*", code))
+    return names
+
+
+def scan_fortran(text, quote=None):
+    """
+    Remove trailing comment from a Fortran line and collapse whitespace
+    outside of string literals. Returns the code and the open quote
+    character, so that strings continued on the next line are kept.
+    Whitespace at either end of the line is kept if it lies inside a
+    string.
+
+    Arguments
+    ---------
+    text  : String value of line without fixed-form columns 1-6
+    quote : Quote character of a string left open by the previous line
+    """
+    code = []
+    opened = quote
+
+    for char in text:
+        if quote:
+            code.append(char)
+            if char == quote:
+                quote = None
+        elif char == "!":
+            break
+        elif char.isspace():
+            if code and code[-1] != " ":
+                code.append(" ")
+        else:
+            code.append(char)
+            if char in "'\"":
+                quote = char
+
+    code = "".join(code)
+    if not opened:
+        code = code.lstrip()
+    if not quote:
+        code = code.rstrip()
+    return code, quote
+
+
+def normalize_fortran(lines, fixed_form):
+    """
+    Remove comments, blank lines and redundant whitespace from Fortran
+    source. Continuation lines are joined to the statement they continue
+    and fixed-form columns beyond 72 are dropped, so every statement is
+    returned as a single line with its label.
+
+    Arguments
+    ---------
+    lines      : List of source lines
+    fixed_form : Boolean for fixed-form source
+    """
+    statements = []
+    continued = False
+    quote = None
+
+    for line in lines:
+        line = line.rstrip("\r\n")
+
+        if fixed_form:
+            line = line.expandtabs(6)[:72]
+            if line[:1] in ["c", "C", "*", "!", "d", "D"]:
+                continue
+            # A "!" in the label field starts a comment that runs to the
+            # end of the line, in column 6 it marks a continuation
+            if "!" in line[:5]:
+                continue
+            if is_continuation(line, fixed_form) and statements:
+                opened = quote
+                code, quote = scan_fortran(line[6:], quote)
+                if code:
+                    statements[-1] += code if opened else " " + code
+                continue
+            label = line[:5].strip()
+            code, quote = scan_fortran(line[6:])
+            if code:
+                statements.append(f"{label} {code}" if label else code)
+            continue
+
+        if continued:
+            if line.lstrip().startswith("&"):
+                line = line.lstrip()[1:]
+            code, quote = scan_fortran(line, quote)
+            if not code:
+                continue
+            statements[-1] += code
+        else:
+            code, quote = scan_fortran(line)
+            if not code:
+                continue
+            statements.append(code)
+
+        # Free-form continuation marks the end of the continued line, also
+        # inside a string where the blanks after it are kept by the scan
+        continued = code.rstrip().endswith("&")
+        if continued:
+            statements[-1] = statements[-1].rstrip()[:-1]
+            if not quote:
+                statements[-1] = statements[-1].rstrip() + " "
+
+    return [statement.strip() + "\n" for statement in statements]
+
+
+def normalize_cpp(lines):
+    """
+    Remove comments, blank lines and redundant whitespace from C or C++
+    source without touching string, character and raw string literals.
+    Line breaks are kept so preprocessor directives stay intact.
+
+    Arguments
+    ---------
+    lines : List of source lines
+    """
+    text = "".join(lines)
+    code = []
+    index = 0
+
+    while index < len(text):
+        char = text[index]
+        last = code[-1][-1] if code else "\n"
+
+        if text.startswith("//", index):
+            while index < len(text) and text[index] != "\n":
+                index += 1 + (text[index] == "\\")
+            continue
+
+        if text.startswith("/*", index):
+            end = text.find("*/", index + 2)
+            index = len(text) if end < 0 else end + 2
+            if last not in " \n":
+                code.append(" ")
+            continue
+
+        # Raw strings may only follow an encoding prefix
+        raw = raw_string.match(text, index)
+        if raw and re.search(r"(^|[^\w])(u8|u|U|L)?$", "".join(code[-3:])[-3:]):
+            end = text.find(f'){raw.group(1)}"', raw.end())
+            end = len(text) if end < 0 else end + len(raw.group(1)) + 2
+            code.append(text[index:end])
+            index = end
+            continue
+
+        # Quotes between digits are C++14 digit separators
+        separator = (
+            char == "'" and last.isdigit() and text[index + 2 : index + 3] != "'"
+        )
+
+        if char in "'\"" and not separator:
+            end = index + 1
+            while end < len(text) and text[end] not in [char, "\n"]:
+                end += 1 + (text[end] == "\\")
+            code.append(text[index : end + 1])
+            index = end + 1
+            continue
+
+        if char in " \t\f\v\r":
+            if last not in " \n":
+                code.append(" ")
+        elif char == "\n":
+            if last == " ":
+                code.pop()
+            if code and code[-1][-1] != "\n":
+                code.append("\n")
+        else:
+            code.append(char)
+        index += 1
+
+    if code and code[-1] == " ":
+        code.pop()
+
+    return "".join(code).splitlines(keepends=True)
+
+
+def normalize_source(lines, sfile):
+    """
+    Normalize source lines for the prompt based on the language of the
+    source file. Files in other languages are returned unchanged.
+
+    Arguments
+    ---------
+    lines : List of source lines
+    sfile : String value of source file path
+    """
+    if is_cpp(sfile):
+        return normalize_cpp(lines)
+    if os.path.splitext(sfile)[1].lower().startswith(".f"):
+        return normalize_fortran(lines, is_fixed_form(sfile))
+    return lines
@@ -0,0 +1,93 @@
+# Module for recording progress of translation runs
+
+import os, json, time
+
+
+class RunManifest:
+    """
+    Append-only record of per-file translation status. Every worker
+    appends JSON lines to its own file in the manifest directory and
+    the latest record for a target across all files wins. Incomplete
+    lines left by a crash are ignored when loading.
+
+    Arguments
+    ---------
+    manifest_dir : String value of manifest directory
+    rank         : Integer value of worker rank
+    """
+
+    def __init__(self, manifest_dir, rank=0):
+        self.manifest_dir = manifest_dir
+        self.path = os.path.join(manifest_dir, f"rank{rank}.jsonl")
+        self.records = {}
+
+        os.makedirs(manifest_dir, exist_ok=True)
+
+        entries = []
+        for name in sorted(os.listdir(manifest_dir)):
+            if not name.endswith(".jsonl"):
+                continue
+            with open(
+                os.path.join(manifest_dir, name), "r", errors="replace"
+            ) as manifest:
+                for line in manifest:
+                    try:
+                        entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+
+        for entry in sorted(entries, key=lambda entry: entry["time"]):
+            self.records[entry["target"]] = entry
+
+    def latest(self, target):
+        """
+        Return latest record for target or None
+
+        Arguments
+        ---------
+        target : String value of target file path
+        """
+        return self.records.get(target)
+
+    def is_done(self, target):
+        """
+        Check if target finished in a previous run and still exists.
+        Targets that failed the compile check are done as well, greedy
+        decoding would generate the same output again. retranslate.py
+        re-queues them explicitly.
+
+        Arguments
+        ---------
+        target : String value of target file path
+        """
+        record = self.latest(target)
+        return (
+            record is not None
+            and record["status"] in ["done", "verified", "invalid"]
+            and os.path.isfile(target)
+        )
+
+    def record(self, target, status, **fields):
+        """
+        Append status record for target and flush it to disk
+
+        Arguments
+        ---------
+        target : String value of target file path
+        status : String value of status (started, done, failed, verified,
+                 invalid or invalidated)
+        fields : Additional values such as tokens, seconds and hash
+        """
+        entry = dict(target=target, status=status, time=time.time(), **fields)
+        self.records[target] = entry
+
+        with open(self.path, "ab+") as manifest:
+            # Start a new line after a line torn by a crash, so only the
+            # torn line is lost
+            if manifest.tell() > 0:
+                manifest.seek(-1, os.SEEK_END)
+                if manifest.read(1) != b"\n":
+                    manifest.write(b"\n")
+            manifest.write((json.dumps(entry) + "\n").encode())
+            manifest.flush()
+            os.fsync(manifest.fileno())
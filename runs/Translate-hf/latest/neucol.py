@@ -1,96 +1,325 @@
 # Module for build managing directory tree
 
-import os, sys, glob, toml
+import os, sys, glob, json, hashlib, tempfile, toml
 
 for path in os.getenv("PYMODULE_PATH").split(":"):
     sys.path.insert(0, path)
 
-import api
+import api, lexer
 
+source_targets = {".f": ".cpp", ".cpp": ".f90"}
+header_targets = {".f90": ".hpp", ".hpp": ".f90"}
+
+
+def create_symbol_index(src_dir, cache_dir=None, pattern="Mods/*.f90"):
+    """
+    Index modules declared in the source tree with their parameters,
+    variables and derived types. The index is persisted and rebuilt when
+    a module file is added, removed or modified.
+
+    Arguments
+    ---------
+    src_dir   : String value of source directory
+    cache_dir : String value of directory to persist the index, disabled
+                if None
+    pattern   : String value of glob pattern of module files below src_dir
+    """
+    files = sorted(glob.glob(pattern, root_dir=src_dir))
+    mtimes = {file: os.path.getmtime(os.path.join(src_dir, file)) for file in files}
+
+    if cache_dir:
+        index_key = hashlib.sha256(
+            (os.path.realpath(src_dir) + ":" + pattern).encode()
+        ).hexdigest()
+        index_file = os.path.join(cache_dir, f"symbols-{index_key}.json")
+
+        if os.path.isfile(index_file):
+            with open(index_file, "r") as cached:
+                entry = json.load(cached)
+            if entry["mtimes"] == mtimes:
+                return entry["modules"]
+
+    modules = {}
+    for file in files:
+        with open(os.path.join(src_dir, file), "r") as source:
+            lines = lexer.normalize_fortran(
+                source.readlines(), lexer.is_fixed_form(file)
+            )
+        for name, module in lexer.scan_declarations(lines).items():
+            module["file"] = file
+            modules[name] = module
+
+    api.display_output(
+        f"Indexed {sum(len(module['symbols']) for module in modules.values())} "
+        + f"symbols in {len(modules)} modules"
+    )
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        handle, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(handle, "w") as cached:
+            json.dump(dict(mtimes=mtimes, modules=modules), cached)
+        os.replace(tmp, index_file)
+
+    return modules
+
+
+def infer_src_mapping(sfile, mapping, index):
+    """
+    Return Fortran lines with the declarations a source file relies on,
+    preceded by a comment naming their module.
+    Only modules reachable from its use statements are considered, and
+    of those only symbols the file references plus the symbols their
+    declarations refer to, such as kind and dimension parameters.
+    Modules that are mapped themselves are named with their target.
+
+    Arguments
+    ---------
+    sfile   : String value of source file path
+    mapping : Dictionary returned by create_src_mapping
+    index   : Dictionary returned by create_symbol_index
+    """
+    with open(sfile, "r") as source:
+        lines = lexer.normalize_fortran(source.readlines(), lexer.is_fixed_form(sfile))
+
+    declared, used = lexer.scan_modules(lines)
+
+    # Modules used by used modules are visible through them
+    modules = []
+    pending = sorted(used - declared)
+    while pending:
+        name = pending.pop(0)
+        if name in index and name not in modules:
+            modules.append(name)
+            pending.extend(index[name]["uses"])
+
+    selected = set()
+    pending = sorted(lexer.scan_identifiers(lines))
+    while pending:
+        name = pending.pop(0)
+        for module in modules:
+            if name in index[module]["symbols"] and (module, name) not in selected:
+                selected.add((module, name))
+                pending.extend(
+                    lexer.scan_identifiers(
+                        [index[module]["symbols"][name]["declaration"]]
+                    )
+                )
+
+    # Modules translated in the same run are named by their target header
+    targets = dict(zip(mapping["src"]["files"], mapping["dest"]["files"]))
 
-def infer_src_mapping(sfile, mapping):
     prompt = []
+    for module in reversed(modules):
+        symbols = [
+            symbol
+            for name, symbol in index[module]["symbols"].items()
+            if (module, name) in selected
+        ]
+        if symbols:
+            location = index[module]["file"]
+            tfile = targets.get(os.path.join(mapping["src"]["dir"], location))
+            if tfile:
+                location += " (" + os.path.relpath(tfile, mapping["dest"]["dir"]) + ")"
+            prompt.append(f"! Module {index[module]['name']} from {location}")
+            prompt.extend(symbol["declaration"] for symbol in symbols)
+
     return prompt
 
 
-def create_src_mapping(filemap):
+def create_dependency_graph(source_files):
+    """
+    Build module dependency graph from Fortran use and module
+    statements. A file depends on every other file in the list that
+    declares a module it uses, modules declared outside the list are
+    ignored.
+
+    Arguments
+    ---------
+    source_files : List of source file paths
+    """
+    declared = {}
+    used = {}
+
+    for sfile in source_files:
+        with open(sfile, "r") as source:
+            declared[sfile], used[sfile] = lexer.scan_modules(source.readlines())
+
+    providers = {}
+    for sfile in source_files:
+        for module in declared[sfile]:
+            providers[module] = sfile
+
+    graph = {}
+    for sfile in source_files:
+        graph[sfile] = set(
+            providers[module]
+            for module in used[sfile]
+            if module in providers and providers[module] != sfile
+        )
+
+    return graph
+
+
+def create_waves(source_files, graph):
+    """
+    Order files in topological waves. Every file in a wave only depends
+    on files in earlier waves, so all files of a wave can be translated
+    together. Files in a dependency cycle are placed in a final wave.
+
+    Arguments
+    ---------
+    source_files : List of source file paths
+    graph        : Dictionary returned by create_dependency_graph
+    """
+    waves = []
+    done = set()
+    remaining = list(source_files)
+
+    while remaining:
+        wave = [sfile for sfile in remaining if graph[sfile] <= done]
+
+        if not wave:
+            api.display_output(
+                f"Dependency cycle between {len(remaining)} files, "
+                + "translating them in one wave"
+            )
+            wave = remaining
+
+        waves.append(wave)
+        done.update(wave)
+        remaining = [sfile for sfile in remaining if sfile not in done]
+
+    return waves
+
+
+def resolve_entries(src_dir, entries, listings):
+    """
+    Resolve filemap entries to paths relative to the source directory.
+    Entries may be glob patterns. Only directories referenced by the
+    entries are listed, and each listing is kept for reuse.
+
+    Arguments
+    ---------
+    src_dir  : String value of source directory
+    entries  : List of filemap entries like "/W/qqb_w.f" or "/W/*.f"
+    listings : Dictionary of directory listings shared between calls
+    """
+    files = []
+
+    for entry in entries:
+        entry = entry.strip("/")
+
+        if any(char in entry for char in "*?["):
+            matches = sorted(glob.glob(entry, root_dir=src_dir))
+        else:
+            sub_dir, file = os.path.split(entry)
+            if sub_dir not in listings:
+                try:
+                    listings[sub_dir] = set(os.listdir(os.path.join(src_dir, sub_dir)))
+                except FileNotFoundError:
+                    listings[sub_dir] = set()
+            matches = [entry] if file in listings[sub_dir] else []
+
+        if not matches:
+            api.display_output(f'Filemap entry "/{entry}" not found in source tree')
+
+        files.extend(matches)
+
+    return files
+
+
+def mapping_stamps(filemap, src_dir, input_files):
+    """
+    Return modification times the resolved mapping depends on, those of
+    the filemap and of every directory its entries refer to. Adding or
+    removing a file changes the time of its directory. Returns None if
+    an entry has a glob pattern in its directory part, since the
+    directories cannot be known without resolving the pattern.
+
+    Arguments
+    ---------
+    filemap     : String value of filemap TOML file
+    src_dir     : String value of source directory
+    input_files : Dictionary loaded from filemap
+    """
+    stamps = {filemap: os.path.getmtime(filemap)}
+
+    for entry in input_files["headers"] + input_files["sources"]:
+        sub_dir = os.path.dirname(entry.strip("/"))
+        if any(char in sub_dir for char in "*?["):
+            return None
+        path = os.path.join(src_dir, sub_dir)
+        stamps[path] = os.path.getmtime(path) if os.path.isdir(path) else None
+
+    return stamps
+
+
+def create_src_mapping(filemap, cache_dir=None):
     """
     Build directory tree from neucol source code.
 
     Arguments
     ---------
-    dest : String value of destination directory
+    filemap   : String value of filemap TOML file
+    cache_dir : String value of directory to cache the resolved mapping
+                keyed on modification times from mapping_stamps,
+                disabled if None
     """
     src_dir = os.getenv("MCFM_HOME") + os.sep + "src"
     dest_dir = os.getenv("MCFM_HOME") + os.sep + "src"
 
-    input_files = toml.load(filemap)
-
-    src_files = []
-    dest_files = []
-
     api.display_output(f'Mapping files from "{filemap}"')
     api.display_output(
         "Please note that existing files will not be replaced in the destination."
     )
 
-    for item in os.walk(src_dir):
+    input_files = toml.load(filemap)
 
-        sub_dir = item[0].replace(src_dir, "")
+    stamps = mapping_stamps(filemap, src_dir, input_files) if cache_dir else None
 
-        for file in item[2]:
-            if sub_dir + os.sep + file in input_files["sources"]:
-                src_files.append(src_dir + os.sep + sub_dir + os.sep + file)
-                if file.endswith(".f"):
-                    dest_files.append(
-                        dest_dir
-                        + os.sep
-                        + sub_dir
-                        + os.sep
-                        + file.replace(".f", ".cpp")
-                    )
+    if stamps:
+        mapping_key = hashlib.sha256(
+            (os.path.realpath(filemap) + ":" + os.path.realpath(src_dir)).encode()
+        ).hexdigest()
+        mapping_file = os.path.join(cache_dir, f"mapping-{mapping_key}.json")
 
-                elif file.endswith(".cpp"):
-                    dest_files.append(
-                        dest_dir
-                        + os.sep
-                        + sub_dir
-                        + os.sep
-                        + file.replace(".cpp", ".f90")
-                    )
-                else:
-                    api.display_output(
-                        f"source {sub_dir + os.sep + file} not recognized."
-                    )
-                    raise NotImplementedError
-
-            elif sub_dir + os.sep + file in input_files["headers"]:
-                src_files.append(src_dir + os.sep + sub_dir + os.sep + file)
-                if file.endswith(".f90"):
-                    dest_files.append(
-                        dest_dir
-                        + os.sep
-                        + sub_dir
-                        + os.sep
-                        + file.replace(".f90", ".hpp")
-                    )
-                elif file.endswith(".hpp"):
-                    dest_files.append(
-                        dest_dir
-                        + os.sep
-                        + sub_dir
-                        + os.sep
-                        + file.replace(".hpp", ".f90")
-                    )
-                else:
-                    api.display_output(
-                        f"header {sub_dir + os.sep + file} not recognized."
-                    )
-                    raise NotImplementedError
+        if os.path.isfile(mapping_file):
+            with open(mapping_file, "r") as cached:
+                entry = json.load(cached)
+            if entry.get("stamps") == stamps:
+                return entry["mapping"]
+
+    src_files = []
+    dest_files = []
+    listings = {}
+    mapped = set()
+
+    for kind, targets in [("headers", header_targets), ("sources", source_targets)]:
+        for file in resolve_entries(src_dir, input_files[kind], listings):
+
+            root, ext = os.path.splitext(file)
+            if ext not in targets:
+                api.display_output(f"{kind[:-1]} /{file} not recognized.")
+                raise NotImplementedError
+
+            src_file = os.path.join(src_dir, file)
+            if src_file not in mapped:
+                mapped.add(src_file)
+                src_files.append(src_file)
+                dest_files.append(os.path.join(dest_dir, root + targets[ext]))
 
     mapping = {
         "src": {"files": src_files, "dir": src_dir},
         "dest": {"files": dest_files, "dir": dest_dir},
     }
 
+    if stamps:
+        # Every rank writes its own temporary file before the rename
+        os.makedirs(cache_dir, exist_ok=True)
+        handle, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(handle, "w") as cached:
+            json.dump(dict(stamps=stamps, mapping=mapping), cached)
+        os.replace(tmp, mapping_file)
+
     return mapping
@@ -0,0 +1,109 @@
+# Module for overlapping host-side work with generation
+
+import queue, threading, collections, concurrent.futures
+
+
+class Prefetcher:
+    """
+    Apply a function to items in a thread pool ahead of the consumer.
+    Results are yielded in the order of the items and at most queue_size
+    results are computed ahead, which bounds the memory held by prepared
+    work that generation has not reached yet.
+
+    Arguments
+    ---------
+    function    : Function applied to every item
+    items       : Iterable of items
+    max_workers : Integer value of worker threads
+    queue_size  : Integer value of results computed ahead of the consumer
+    """
+
+    def __init__(self, function, items, max_workers=2, queue_size=8):
+        self.function = function
+        self.items = iter(items)
+        self.queue_size = max(queue_size, 1)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self.pending = collections.deque()
+
+    def fill(self):
+        while len(self.pending) < self.queue_size:
+            try:
+                item = next(self.items)
+            except StopIteration:
+                return
+            self.pending.append(self.pool.submit(self.function, item))
+
+    def __iter__(self):
+        try:
+            self.fill()
+            while self.pending:
+                future = self.pending.popleft()
+                self.fill()
+                yield future.result()
+        finally:
+            for future in self.pending:
+                future.cancel()
+            self.pool.shutdown()
+
+
+class WriteQueue:
+    """
+    Run calls on a background thread in the order they are put. The
+    queue is bounded, so put blocks once queue_size calls are waiting
+    and host-side work cannot fall arbitrarily far behind generation.
+    The first exception raised by a call is raised again by put, join
+    or close and later calls are skipped.
+
+    Arguments
+    ---------
+    queue_size : Integer value of calls waiting before put blocks
+    """
+
+    def __init__(self, queue_size=8):
+        self.calls = queue.Queue(max(queue_size, 1))
+        self.error = None
+        self.thread = threading.Thread(target=self.drain, daemon=True)
+        self.thread.start()
+
+    def drain(self):
+        while True:
+            call = self.calls.get()
+            if call is None:
+                return
+            function, args, kwargs = call
+            if self.error is None:
+                try:
+                    function(*args, **kwargs)
+                except Exception as error:
+                    self.error = error
+            self.calls.task_done()
+
+    def put(self, function, *args, **kwargs):
+        """
+        Queue call of function
+
+        Arguments
+        ---------
+        function : Function to call on the background thread
+        args     : Positional arguments of the call
+        kwargs   : Keyword arguments of the call
+        """
+        if self.error is not None:
+            raise self.error
+        self.calls.put((function, args, kwargs))
+
+    def join(self):
+        """
+        Wait for all queued calls to finish
+        """
+        self.calls.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """
+        Wait for all queued calls to finish and stop the thread
+        """
+        self.join()
+        self.calls.put(None)
+        self.thread.join()
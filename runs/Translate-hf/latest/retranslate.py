@@ -0,0 +1,114 @@
+# Re-queue files in directories exercised by failing MCFM process checks
+
+# Import libraries
+import os, sys, json, toml
+
+for path in os.getenv("PYMODULE_PATH").split(":"):
+    sys.path.insert(0, path)
+
+import api, neucol, cache, manifest
+
+from typing import Optional
+import fire
+
+
+def select_tests(report, select=None):
+    """
+    Return list of failing tests in a runtests.py report, or of the
+    selected tests when names are given
+
+    Arguments
+    ---------
+    report : Dictionary loaded from runtests.py report
+    select : List of test names to use regardless of their outcome
+    """
+    if select:
+        tests = [test for test in report["tests"] if test["name"] in select]
+    elif not report["build"]["ok"]:
+        api.display_output("Build failed, no test results in report")
+        raise ValueError
+    else:
+        tests = [test for test in report["tests"] if not test["ok"]]
+
+    return tests
+
+
+def main(
+    filemap: str,
+    report: str,
+    output: str = "filemaps/retranslate.toml",
+    select: Optional[str] = None,
+    cache_dir: Optional[str] = "cache",
+    manifest_dir: Optional[str] = "manifest",
+    remove_targets: bool = False,
+):
+
+    with open(report, "r") as results:
+        report = json.load(results)
+
+    if select:
+        select = select.split(",") if isinstance(select, str) else list(select)
+
+    tests = select_tests(report, select)
+    names = [test["name"] for test in tests]
+    directories = {directory for test in tests for directory in test["directories"]}
+
+    api.display_output(
+        f"Selected tests: {', '.join(names) or 'none'}, "
+        + f"directories: {', '.join(sorted(directories)) or 'none'}"
+    )
+
+    src_dir = os.getenv("MCFM_HOME") + os.sep + "src"
+    input_files = toml.load(filemap)
+    listings = {}
+
+    output_files = dict(headers=[], sources=[])
+    for kind in output_files:
+        for file in neucol.resolve_entries(src_dir, input_files[kind], listings):
+            if file.split("/")[0] in directories:
+                output_files[kind].append("/" + file)
+
+    if not any(output_files.values()):
+        api.display_output(f'No entries of "{filemap}" in selected directories')
+        return
+
+    with open(output, "w") as outfile:
+        outfile.write(f"# neucol toml, entries of {filemap} in failing directories\n")
+        toml.dump(output_files, outfile)
+
+    api.display_output(
+        f"Wrote {len(output_files['headers'])} headers and "
+        + f"{len(output_files['sources'])} sources to \"{output}\""
+    )
+
+    # Invalidate the same files translate.py would map from the new filemap
+    mapping = neucol.create_src_mapping(output)
+    source_files = mapping["src"]["files"]
+    target_files = mapping["dest"]["files"]
+
+    if cache_dir and os.path.isdir(cache_dir):
+        store = cache.TranslationCache(cache_dir, float("inf"))
+        removed = store.remove_sources(source_files)
+        api.display_output(f'Removed {removed} entries from cache "{cache_dir}"')
+
+    if manifest_dir:
+        progress = manifest.RunManifest(manifest_dir)
+        for sfile, tfile in zip(source_files, target_files):
+            progress.record(tfile, "invalidated", source=sfile, tests=names)
+        api.display_output(
+            f'Invalidated {len(target_files)} targets in manifest "{manifest_dir}"'
+        )
+
+    # Without a manifest translate.py skips targets that already exist
+    if remove_targets:
+        for tfile in target_files:
+            if os.path.isfile(tfile):
+                os.remove(tfile)
+    elif not manifest_dir:
+        api.display_output("Existing targets are kept, use --remove_targets")
+
+    api.display_output(f"Re-translate with --filemap {output}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
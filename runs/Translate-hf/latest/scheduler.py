@@ -0,0 +1,257 @@
+# Module for continuous batching of generation requests
+
+import queue, collections, concurrent.futures
+
+import torch, transformers
+
+
+def cache_tensors(cache):
+    """
+    Return list of (key, value) tensors per layer from a DynamicCache
+
+    Arguments
+    ---------
+    cache : DynamicCache filled by a model forward pass
+    """
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def create_cache(tensors):
+    """
+    Create DynamicCache from list of (key, value) tensors per layer
+
+    Arguments
+    ---------
+    tensors : List of (key, value) tensors with shape [batch, heads, length, dim]
+    """
+    if hasattr(transformers.DynamicCache, "from_legacy_cache"):
+        return transformers.DynamicCache.from_legacy_cache(tuple(tensors))
+    return transformers.DynamicCache(tensors)
+
+
+def pad_left(tensor, length, dim):
+    """
+    Pad tensor with zeros on the left of dimension dim up to length
+
+    Arguments
+    ---------
+    tensor : Tensor to pad
+    length : Integer value of target length
+    dim    : Integer value of dimension to pad
+    """
+    shape = list(tensor.shape)
+    shape[dim] = length - tensor.shape[dim]
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+class ContinuousBatcher:
+    """
+    Iteration-level scheduler for greedy decoding. Requests are admitted
+    into the running batch as soon as others finish, so one long output
+    does not keep the rest of the batch idle. Every admitted request is
+    prefilled on its own and its key/value cache is merged into the
+    batch cache with left padding.
+
+    Arguments
+    ---------
+    model                : Causal language model
+    eos_token_id         : Integer value of end of sequence token
+    max_batch_size       : Integer value of maximum running sequences
+    max_tokens_in_flight : Integer value of maximum prompt plus new tokens
+                           reserved by running sequences
+    """
+
+    def __init__(self, model, eos_token_id, max_batch_size, max_tokens_in_flight):
+        self.model = model
+        self.eos_token_id = eos_token_id
+        self.max_batch_size = max_batch_size
+        self.max_tokens_in_flight = max_tokens_in_flight
+        self.requests = queue.Queue()
+
+    def submit(self, input_ids, max_new_tokens, stop_check=None):
+        """
+        Queue a request and return a future that resolves to a tuple of
+        generated token ids and stop reason ("eos", "length" or a reason
+        returned by stop_check)
+
+        Arguments
+        ---------
+        input_ids      : List of prompt token ids
+        max_new_tokens : Integer value of maximum generated tokens
+        stop_check     : StopCheck for early stopping, disabled if None
+        """
+        future = concurrent.futures.Future()
+        self.requests.put(
+            dict(
+                input_ids=input_ids,
+                max_new_tokens=max_new_tokens,
+                stop_check=stop_check,
+                future=future,
+            )
+        )
+        return future
+
+    def run(self, stop_when_idle=True):
+        """
+        Process queued requests. Returns once all requests are finished
+        if stop_when_idle is set, otherwise waits for new requests.
+
+        Arguments
+        ---------
+        stop_when_idle : Boolean to return when no requests are left
+        """
+        self.waiting = collections.deque()
+        self.reset()
+
+        while True:
+            block = len(self.active) == 0 and len(self.waiting) == 0
+
+            if block and stop_when_idle and self.requests.empty():
+                return
+
+            try:
+                while True:
+                    self.waiting.append(self.requests.get(block=block))
+                    block = False
+            except queue.Empty:
+                pass
+
+            with torch.no_grad():
+                self.admit()
+
+            if not self.active:
+                continue
+
+            try:
+                with torch.no_grad():
+                    self.step()
+            except Exception as error:
+                # Waiting requests are admitted into a fresh batch
+                for sequence in self.active:
+                    sequence["future"].set_exception(error)
+                self.reset()
+
+    def reset(self):
+        self.active = []
+        self.tensors = None
+        self.mask = None
+        self.tokens = None
+
+    def admit(self):
+        while self.waiting and len(self.active) < self.max_batch_size:
+            request = self.waiting[0]
+            reserved = sum(
+                len(sequence["input_ids"]) + sequence["max_new_tokens"]
+                for sequence in self.active
+            )
+            requested = len(request["input_ids"]) + request["max_new_tokens"]
+
+            if self.active and reserved + requested > self.max_tokens_in_flight:
+                break
+
+            self.waiting.popleft()
+            if not request["future"].set_running_or_notify_cancel():
+                continue
+
+            # A failed prefill only fails its own request, the running
+            # batch is left untouched
+            try:
+                merged = self.prefill(request)
+            except Exception as error:
+                request["future"].set_exception(error)
+                continue
+
+            if merged is None:
+                continue
+
+            self.tensors, self.mask, self.tokens = merged
+            self.active.append(request)
+
+    def prefill(self, request):
+        input_ids = torch.tensor([request["input_ids"]], device=self.model.device)
+        cache = transformers.DynamicCache()
+        outputs = self.model(input_ids=input_ids, past_key_values=cache, use_cache=True)
+        token = outputs.logits[:, -1].argmax(-1)
+
+        request["output_ids"] = [int(token)]
+        if self.finish(request):
+            return None
+
+        tensors = cache_tensors(cache)
+        mask = torch.ones_like(input_ids)
+
+        if self.tensors is None:
+            return tensors, mask, token
+
+        length = max(self.mask.shape[1], mask.shape[1])
+        tensors = [
+            (
+                torch.cat([pad_left(keys, length, 2), pad_left(new_keys, length, 2)]),
+                torch.cat(
+                    [pad_left(values, length, 2), pad_left(new_values, length, 2)]
+                ),
+            )
+            for (keys, values), (new_keys, new_values) in zip(self.tensors, tensors)
+        ]
+        mask = torch.cat([pad_left(self.mask, length, 1), pad_left(mask, length, 1)])
+        return tensors, mask, torch.cat([self.tokens, token])
+
+    def step(self):
+        self.mask = torch.cat(
+            [self.mask, self.mask.new_ones(len(self.active), 1)], dim=1
+        )
+        cache = create_cache(self.tensors)
+
+        outputs = self.model(
+            input_ids=self.tokens[:, None],
+            attention_mask=self.mask,
+            position_ids=self.mask.sum(-1, keepdim=True) - 1,
+            past_key_values=cache,
+            use_cache=True,
+        )
+
+        self.tensors = cache_tensors(cache)
+        self.tokens = outputs.logits[:, -1].argmax(-1)
+
+        keep = []
+        for index, sequence in enumerate(self.active):
+            sequence["output_ids"].append(int(self.tokens[index]))
+            if not self.finish(sequence):
+                keep.append(index)
+
+        if len(keep) < len(self.active):
+            if len(keep) == 0:
+                self.reset()
+                return
+
+            indices = torch.tensor(keep, device=self.mask.device)
+            self.active = [self.active[index] for index in keep]
+            self.tokens = self.tokens[indices]
+            self.mask = self.mask[indices]
+
+            # Drop left padding columns that no remaining sequence uses
+            start = int((self.mask.sum(0) > 0).nonzero()[0])
+            self.mask = self.mask[:, start:]
+            self.tensors = [
+                (keys[indices, :, start:], values[indices, :, start:])
+                for keys, values in self.tensors
+            ]
+
+    def finish(self, sequence):
+        token = sequence["output_ids"][-1]
+        stop_reason = None
+
+        if token == self.eos_token_id:
+            stop_reason = "eos"
+        elif sequence["stop_check"]:
+            stop_reason = sequence["stop_check"].update([token])
+
+        if stop_reason is None:
+            if len(sequence["output_ids"]) < sequence["max_new_tokens"]:
+                return False
+            stop_reason = "length"
+
+        sequence["future"].set_result((sequence["output_ids"], stop_reason))
+        return True
@@ -0,0 +1,115 @@
+# Module for sharding code conversion across torchrun workers
+
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_workers():
+    """
+    Read torchrun environment and initialize the process group when
+    more than one worker is launched. NCCL is used when GPUs are
+    available and gloo otherwise.
+    """
+    rank = int(os.getenv("RANK", 0))
+    local_rank = int(os.getenv("LOCAL_RANK", 0))
+    world_size = int(os.getenv("WORLD_SIZE", 1))
+
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        device = local_rank
+        backend = "nccl"
+    else:
+        device = "cpu"
+        backend = "gloo"
+
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+
+    return dict(rank=rank, world_size=world_size, device=device)
+
+
+def finalize_workers():
+    """
+    Destroy process group if one was initialized
+    """
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def barrier(workers):
+    """
+    Wait for all workers to reach this point
+
+    Arguments
+    ---------
+    workers : Dictionary returned by init_workers
+    """
+    if workers["world_size"] > 1:
+        dist.barrier()
+
+
+def broadcast(value, workers):
+    """
+    Broadcast a picklable value from rank 0 to all workers
+
+    Arguments
+    ---------
+    value   : Value on rank 0, ignored on other ranks
+    workers : Dictionary returned by init_workers
+    """
+    if workers["world_size"] == 1:
+        return value
+
+    objects = [value]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+def gather(value, workers):
+    """
+    Gather a picklable value from all workers to rank 0. Returns a list
+    ordered by rank on rank 0 and None elsewhere.
+
+    Arguments
+    ---------
+    value   : Value on the current rank
+    workers : Dictionary returned by init_workers
+    """
+    if workers["world_size"] == 1:
+        return [value]
+
+    objects = [None] * workers["world_size"] if workers["rank"] == 0 else None
+    dist.gather_object(value, objects, dst=0)
+    return objects
+
+
+def create_shard(source_files, target_files, workers):
+    """
+    Select the source and target files for the current rank. Files are
+    assigned largest first to the least loaded rank so that every
+    worker receives a similar number of bytes, and the assignment only
+    depends on file sizes and paths.
+
+    Arguments
+    ---------
+    source_files : List of source file paths
+    target_files : List of target file paths
+    workers      : Dictionary returned by init_workers
+    """
+    pairs = sorted(
+        zip(source_files, target_files),
+        key=lambda pair: (-os.path.getsize(pair[0]), pair[0]),
+    )
+
+    loads = [0] * workers["world_size"]
+    shards = [[] for _ in range(workers["world_size"])]
+
+    for sfile, tfile in pairs:
+        rank = loads.index(min(loads))
+        loads[rank] += os.path.getsize(sfile)
+        shards[rank].append((sfile, tfile))
+
+    shard = shards[workers["rank"]]
+    return [pair[0] for pair in shard], [pair[1] for pair in shard]
@@ -0,0 +1,141 @@
+# Module for stopping generation early at code fences and repetition loops
+
+import torch, transformers
+
+
+class StopCheck:
+    """
+    Incremental check of a single generated sequence. The sequence stops
+    with reason "fence" once the code block opened by the first fence
+    line is closed, and with reason "repetition" once the last
+    repetition_tokens tokens repeat a block of at most max_period tokens
+    at least three times. Tokens after an end of sequence token are
+    ignored.
+
+    Arguments
+    ---------
+    tokenizer         : Tokenizer for the model
+    eos_token_id      : Integer value or list of end of sequence tokens
+    fence             : Boolean to stop after the closing code fence
+    repetition_tokens : Integer value of repeated tokens that count as a
+                        loop, disabled if zero
+    max_period        : Integer value of longest repeated block in tokens
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        eos_token_id=None,
+        fence=True,
+        repetition_tokens=0,
+        max_period=64,
+    ):
+        if eos_token_id is None:
+            eos_token_id = tokenizer.eos_token_id
+        if not isinstance(eos_token_id, (list, tuple)):
+            eos_token_id = [eos_token_id]
+
+        self.tokenizer = tokenizer
+        self.eos_token_id = eos_token_id
+        self.fence = fence
+        self.repetition_tokens = repetition_tokens
+        self.max_period = max_period
+
+        self.ids = []
+        self.finished = False
+        self.line_start = 0
+        self.line_offset = 0
+        self.fences = 0
+
+        # Number of consecutive tokens equal to the token period steps back
+        self.runs = [0] * max_period
+
+    def update(self, tokens):
+        """
+        Add generated tokens and return the stop reason or None
+
+        Arguments
+        ---------
+        tokens : List of new token ids
+        """
+        for token in tokens:
+            if self.finished:
+                return None
+            if token in self.eos_token_id:
+                self.finished = True
+                return None
+
+            self.ids.append(token)
+
+            if self.repetition_tokens and self.repeats():
+                return "repetition"
+
+        if self.fence and self.closes_fence():
+            return "fence"
+        return None
+
+    def repeats(self):
+        looped = False
+        for period in range(1, min(self.max_period, len(self.ids) - 1) + 1):
+            if self.ids[-1] == self.ids[-1 - period]:
+                run = self.runs[period - 1] = self.runs[period - 1] + 1
+                looped |= run >= 2 * period and run + period >= self.repetition_tokens
+            else:
+                self.runs[period - 1] = 0
+        return looped
+
+    def closes_fence(self):
+        # Lines are decoded together with their tokens, since tokens on
+        # their own do not decode to the same text
+        text = self.tokenizer.decode(self.ids[self.line_start :])
+        end = text.rfind("\n")
+        if end < self.line_offset:
+            return False
+
+        for line in text[self.line_offset : end].split("\n"):
+            if line.strip().startswith("```"):
+                self.fences += 1
+
+        if text.endswith("\n"):
+            self.line_start, self.line_offset = len(self.ids), 0
+        else:
+            self.line_offset = end + 1
+
+        return self.fences >= 2
+
+
+class EarlyStoppingCriteria(transformers.StoppingCriteria):
+    """
+    Stopping criteria for model.generate that applies a StopCheck to
+    every sequence of the batch and keeps the stop reasons
+
+    Arguments
+    ---------
+    tokenizer     : Tokenizer for the model
+    prompt_length : Integer value of padded prompt tokens
+    batch_size    : Integer value of sequences in the batch
+    eos_token_id  : Integer value or list of end of sequence tokens
+    options       : Keyword arguments passed to StopCheck
+    """
+
+    def __init__(
+        self, tokenizer, prompt_length, batch_size, eos_token_id=None, **options
+    ):
+        self.checks = [
+            StopCheck(tokenizer, eos_token_id, **options) for row in range(batch_size)
+        ]
+        self.reasons = [None] * batch_size
+        self.length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # Assisted decoding can add several tokens per call
+        new_tokens = input_ids[:, self.length :].tolist()
+        self.length = input_ids.shape[1]
+
+        for row, tokens in enumerate(new_tokens):
+            if self.reasons[row] is None:
+                self.reasons[row] = self.checks[row].update(tokens)
+
+        return torch.tensor(
+            [reason is not None for reason in self.reasons], device=input_ids.device
+        )
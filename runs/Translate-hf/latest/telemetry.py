@@ -0,0 +1,66 @@
+# Module for recording per-file telemetry of translation runs
+
+import os, json, time
+
+import torch
+
+
+def peak_gpu_memory(device):
+    """
+    Return peak allocated GPU memory in megabytes since the last reset,
+    zero when running on CPU
+
+    Arguments
+    ---------
+    device : Device index or "cpu"
+    """
+    if device == "cpu" or not torch.cuda.is_available():
+        return 0
+    return torch.cuda.max_memory_allocated(device) / 1024**2
+
+
+def reset_gpu_memory(device):
+    """
+    Reset peak allocated GPU memory so the next reading covers only the
+    following generation
+
+    Arguments
+    ---------
+    device : Device index or "cpu"
+    """
+    if device != "cpu" and torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+class TelemetryLog:
+    """
+    JSON lines stream of per-file measurements. Every worker appends to
+    its own file next to the job output, and records carry the run id
+    so several runs can share the same files.
+
+    Arguments
+    ---------
+    path : String value of telemetry file path, the rank is inserted
+           before the extension
+    run  : String value identifying the run
+    rank : Integer value of worker rank
+    """
+
+    def __init__(self, path, run, rank=0):
+        root, ext = os.path.splitext(path)
+        self.path = f"{root}.rank{rank}{ext}"
+        self.run = run
+        self.rank = rank
+
+    def record(self, **fields):
+        """
+        Append a record to the telemetry file
+
+        Arguments
+        ---------
+        fields : Values measured for a file
+        """
+        entry = dict(run=self.run, rank=self.rank, time=time.time(), **fields)
+
+        with open(self.path, "a") as telemetry:
+            telemetry.write(json.dumps(entry) + "\n")
@@ -1,15 +1,16 @@
 # Prompt engineering for building diffusion stencils for constant and variable coefficient equation
 
 # Import libraries
-import os, sys, toml
+import os, sys, math, time, functools, threading, toml
 
 for path in os.getenv("PYMODULE_PATH").split(":"):
     sys.path.insert(0, path)
 
-import api, neucol
+import api, neucol, engine, shard, cache, manifest, lexer, scheduler, telemetry
+import verify, overlap, budget, stopping
 
 from typing import Optional
-import fire, transformers, torch
+import fire, transformers
 from alive_progress import alive_bar
 
 
@@ -19,35 +20,103 @@ def main(
     max_new_tokens: int = 4096,
     batch_size: int = 8,
     max_length: Optional[int] = None,
+    prefix_cache: bool = False,
+    llm_choice: Optional[int] = None,
+    cache_dir: Optional[str] = "cache",
+    cache_size: int = 1024,
+    stream: bool = False,
+    manifest_dir: Optional[str] = "manifest",
+    chunk_tokens: Optional[int] = None,
+    waves: bool = False,
+    server: Optional[str] = None,
+    continuous: bool = False,
+    max_tokens_in_flight: int = 65536,
+    precision: Optional[str] = None,
+    draft_ckpt: Optional[str] = None,
+    prompt_lookup: Optional[int] = None,
+    telemetry_file: Optional[str] = "telemetry.jsonl",
+    verify_cpp: bool = False,
+    verify_flags: str = "-std=c++17",
+    verify_workers: int = 4,
+    pipelined: bool = False,
+    prepare_workers: int = 2,
+    queue_size: int = 8,
+    adaptive_budget: bool = False,
+    budget_margin: float = 1.5,
+    ratio_file: str = "ratios/ratios.json",
+    stop_at_fence: bool = False,
+    repetition_tokens: int = 0,
+    symbol_context: bool = False,
 ):
 
-    llm_choice = api.get_user_input(
-        f"LLM powered code conversion tool that uses the transformers API "
-        + f"to test different models.\n\t1. mistral-7b\n\t2. codellama-7b\n\t3. gemma-7b\nSelect "
-        + f"the model you would like to interact with"
-    )
+    workers = shard.init_workers()
 
-    if int(llm_choice) == 1:
-        ckpt_dir = os.getenv("MODEL_HOME") + os.sep + "mistral/Mistral-7B-Instruct-v0.1"
-    elif int(llm_choice) == 2:
-        ckpt_dir = (
-            os.getenv("MODEL_HOME") + os.sep + "codellama/CodeLlama-7b-Instruct-hf"
-        )
-    elif int(llm_choice) == 3:
-        ckpt_dir = os.getenv("MODEL_HOME") + os.sep + "google/gemma-7b-it"
-    else:
-        api.display_output(f"Option {llm_choice} not defined")
+    if continuous and (prefix_cache or stream):
+        api.display_output("Continuous batching runs without prefix cache or streaming")
+        raise NotImplementedError
+
+    if adaptive_budget and stream:
+        api.display_output("Adaptive budgets retry truncated chunks and cannot stream")
+        raise NotImplementedError
+
+    if pipelined and continuous:
+        api.display_output("Continuous batching already overlaps host-side work")
         raise NotImplementedError
 
-    if not os.path.exists(ckpt_dir):
+    speculative = bool(draft_ckpt or prompt_lookup)
+
+    if speculative and (prefix_cache or continuous):
         api.display_output(
-            f'Checkpoint directory does not exist for option "{llm_choice}"'
+            "Speculative decoding runs without prefix cache or continuous batching"
         )
         raise NotImplementedError
+
+    if server:
+        if prefix_cache or stream or continuous or speculative:
+            api.display_output(
+                "Prefix cache, streaming, continuous batching and speculative "
+                + "decoding need a local model"
+            )
+            raise NotImplementedError
+
+        pipeline = engine.RemotePipeline(server)
+        ckpt_dir = pipeline.ckpt_dir
+        api.display_output(f'Using inference server "{server}" serving "{ckpt_dir}"')
+
     else:
-        api.display_output(f'Checkpoint directory exists for option "{llm_choice}"')
+        if llm_choice is None and workers["rank"] == 0:
+            llm_choice = api.get_user_input(
+                f"LLM powered code conversion tool that uses the transformers API "
+                + f"to test different models.\n\t1. mistral-7b\n\t2. codellama-7b\n\t3. gemma-7b"
+                + f"\n\t4. tiny-random\nSelect the model you would like to interact with"
+            )
+
+        llm_choice = shard.broadcast(llm_choice, workers)
+
+        names = list(engine.checkpoints)
+        if str(llm_choice) not in [str(option) for option in range(1, len(names) + 1)]:
+            api.display_output(f"Option {llm_choice} not defined")
+            raise NotImplementedError
+
+        ckpt_dir = (
+            os.getenv("MODEL_HOME")
+            + os.sep
+            + engine.checkpoints[names[int(llm_choice) - 1]]
+        )
+
+        if not os.path.exists(ckpt_dir):
+            api.display_output(
+                f'Checkpoint directory does not exist for option "{llm_choice}"'
+            )
+            raise NotImplementedError
+        else:
+            api.display_output(f'Checkpoint directory exists for option "{llm_choice}"')
+
+    # Mapping and symbol index are kept apart from the translation cache,
+    # which evicts every JSON file in its directory
+    neucol_dir = os.path.join(cache_dir, "neucol") if cache_dir else None
 
-    mapping = neucol.create_src_mapping(filemap)
+    mapping = neucol.create_src_mapping(filemap, neucol_dir)
 
     source_files = mapping["src"]["files"]
     target_files = mapping["dest"]["files"]
@@ -58,109 +127,697 @@ def main(
         )
         raise ValueError
 
+    if waves:
+        schedule = neucol.create_waves(
+            source_files, neucol.create_dependency_graph(source_files)
+        )
+        api.display_output(f"Scheduling translation in {len(schedule)} waves")
+    else:
+        schedule = [source_files]
+
+    file_waves = {sfile: index for index, wave in enumerate(schedule) for sfile in wave}
+
+    source_files, target_files = shard.create_shard(source_files, target_files, workers)
+
     api.display_output(f'Loading template from "{template}"')
     instructions = toml.load(template)["instructions"]
 
-    api.display_output("Starting code conversion process")
+    params = dict(
+        max_new_tokens=max_new_tokens, max_length=max_length, precision=precision
+    )
+
+    # Chunk boundaries and generation budgets change the stitched output
+    if chunk_tokens is not None:
+        params["chunk_tokens"] = chunk_tokens
+    if adaptive_budget:
+        params["adaptive_budget"] = dict(margin=budget_margin)
+
+    if stop_at_fence or repetition_tokens:
+        early_stop = dict(fence=stop_at_fence, repetition_tokens=repetition_tokens)
+        params["early_stop"] = early_stop
+    else:
+        early_stop = None
+
+    if symbol_context:
+        index = neucol.create_symbol_index(mapping["src"]["dir"], neucol_dir)
+
+    if manifest_dir:
+        progress = manifest.RunManifest(manifest_dir, workers["rank"])
+
+    if telemetry_file:
+        log = telemetry.TelemetryLog(
+            telemetry_file,
+            shard.broadcast(time.strftime("%Y%m%d-%H%M%S"), workers),
+            workers["rank"],
+        )
+
+    if verify_cpp:
+        verifier = verify.CompileVerifier(
+            sorted(
+                set(os.path.dirname(tfile) for tfile in mapping["dest"]["files"])
+                | {mapping["dest"]["dir"]}
+            ),
+            os.getenv("CXX", "g++"),
+            verify_flags,
+            os.path.join(cache_dir, "verify") if cache_dir else None,
+            verify_workers,
+        )
+        verified = 0
+        invalid = 0
+
+    def check_targets(wait=False):
+        nonlocal verified, invalid
+        for tfile, result in verifier.collect(wait):
+            job = keys[tfile]
+            if result["ok"]:
+                verified += 1
+            else:
+                invalid += 1
+                api.display_output(
+                    f"Compile check failed for {tfile}: "
+                    + result["errors"].strip().split("\n")[0]
+                )
+            if manifest_dir:
+                progress.record(
+                    tfile,
+                    "verified" if result["ok"] else "invalid",
+                    hash=job["key"],
+                    errors=result["errors"][-4096:],
+                )
+
+    jobs = []
+    for sfile, tfile in zip(source_files, target_files):
+
+        # Files recorded in the manifest are retried unless they finished,
+        # other existing targets are treated as finished by hand.
+        if manifest_dir and progress.latest(tfile):
+            if progress.is_done(tfile):
+                continue
+        elif os.path.isfile(tfile):
+            continue
+
+        source_code = engine.read_source(sfile)
+
+        # Declarations from used modules the Fortran source refers to
+        if symbol_context and not lexer.is_cpp(sfile):
+            context = neucol.infer_src_mapping(sfile, mapping, index)
+        else:
+            context = []
+
+        jobs.append(
+            dict(
+                source=sfile,
+                target=tfile,
+                wave=file_waves[sfile],
+                source_code=source_code,
+                context=context,
+                key=cache.create_key(
+                    ckpt_dir, instructions, params, source_code, context
+                ),
+            )
+        )
 
-    tokenizer = transformers.AutoTokenizer.from_pretrained(ckpt_dir)
-    pipeline = transformers.pipeline(
-        "text-generation",
-        model=ckpt_dir,
-        torch_dtype=torch.float16,
-        device=0,
+    keys = {job["target"]: job for job in jobs}
+
+    start_time = time.time()
+    cached = 0
+
+    if cache_dir:
+        store = cache.TranslationCache(cache_dir, cache_size * 1024**2)
+
+        pending = []
+        for job in jobs:
+            entry = store.get(job["key"])
+            if entry:
+                engine.write_target(job["target"], instructions, entry["output"])
+                if verify_cpp:
+                    verifier.submit(job["target"])
+                if manifest_dir:
+                    progress.record(job["target"], "done", hash=job["key"], cached=True)
+                if telemetry_file:
+                    log.record(
+                        source=job["source"],
+                        target=job["target"],
+                        cache="hit",
+                        output_tokens=entry["metadata"].get("output_tokens"),
+                    )
+                cached += 1
+            else:
+                pending.append(job)
+        jobs = pending
+
+    api.display_output(
+        f"Rank {workers['rank']} starting code conversion process "
+        + f"for {len(jobs)} of {len(source_files)} files ({cached} from cache)"
     )
 
-    with alive_bar(len(source_files), bar="blocks") as bar:
+    tasks = []
 
-        for sfile, tfile in zip(source_files, target_files):
+    def prepare_job(job, tokenizer):
+        def count_tokens(text):
+            return len(tokenizer(text, add_special_tokens=False)["input_ids"])
 
-            bar.text(sfile.replace(mapping["src"]["dir"] + os.sep, ""))
-            bar()
+        with open(job["source"], "r") as source:
+            job["raw_tokens"] = count_tokens(source.read())
+        job["source_tokens"] = count_tokens("".join(job["source_code"]))
 
-            if not os.path.isfile(tfile):
+        # Context is repeated in every chunk and takes room from the source
+        prompt_tokens = template_tokens
+        if job["context"]:
+            prompt_tokens = engine.count_tokens(
+                tokenizer, engine.create_conversation(instructions, [], job["context"])
+            )
 
-                source_code = []
-                with open(sfile, "r") as source:
+        chunks = lexer.create_chunks(
+            job["source_code"],
+            lexer.is_fixed_form(job["source"]),
+            lambda lines: count_tokens("".join(lines)),
+            max(chunk_tokens - (prompt_tokens - template_tokens), chunk_tokens // 2),
+        )
+        job["outputs"] = [None] * len(chunks)
+        job["stop_reasons"] = [None] * len(chunks)
+        job["output_tokens"] = 0
+        job["drafted"] = 0
+        job["accepted"] = 0
+        job["ntokens"] = 0
+        job["retries"] = 0
+
+        job_tasks = []
+        for index, chunk in enumerate(chunks):
+            conversation = engine.create_conversation(
+                instructions, chunk, job["context"]
+            )
+            ntokens = engine.count_tokens(tokenizer, conversation)
+            job["ntokens"] += ntokens
+            job_tasks.append(
+                dict(
+                    job=job,
+                    index=index,
+                    conversation=conversation,
+                    ntokens=ntokens,
+                    source_tokens=ntokens - prompt_tokens,
+                    max_new_tokens=(
+                        budget.size_budget(
+                            ntokens - prompt_tokens,
+                            output_ratio,
+                            budget_margin,
+                            max_new_tokens,
+                        )
+                        if adaptive_budget
+                        else max_new_tokens
+                    ),
+                )
+            )
+        return job_tasks
+
+    def display_normalization():
+        prepared = [job for job in jobs if "source_tokens" in job]
+        api.display_output(
+            "Normalized sources to "
+            + f"{sum(job['source_tokens'] for job in prepared)} tokens, saving "
+            + f"{sum(job['raw_tokens'] - job['source_tokens'] for job in prepared)} "
+            + "tokens of comments and whitespace"
+        )
+
+    # Fast tokenizers must not be shared between threads
+    local = threading.local()
+
+    def prefetch_job(job):
+        if not hasattr(local, "tokenizer"):
+            local.tokenizer = transformers.AutoTokenizer.from_pretrained(ckpt_dir)
+        return prepare_job(job, local.tokenizer)
+
+    def stream_batches(group):
+        # Files are prepared by the prefetcher while earlier batches
+        # generate, tasks are sorted by length within the queued window.
+        # Single task batches keep chunk order, streaming appends chunks
+        # to the target in the order they are generated.
+        size = 1 if prefix_cache or stream or speculative else batch_size
+        window = []
+        for job_tasks in overlap.Prefetcher(
+            prefetch_job, group, prepare_workers, queue_size
+        ):
+            if size == 1:
+                yield from ([task] for task in job_tasks)
+                continue
+            window.extend(job_tasks)
+            if len(window) >= size:
+                batches = engine.create_batches(window, size)
+                window = batches.pop() if len(batches[-1]) < size else []
+                yield from batches
+        if window:
+            yield from engine.create_batches(window, size)
+
+    if pipelined:
+        writer = overlap.WriteQueue(queue_size)
+        defer = writer.put
+    else:
 
-                    is_comment = False
-                    is_comment_block = False
+        def defer(function, *args, **kwargs):
+            function(*args, **kwargs)
 
-                    for line in source.readlines():
-                        is_comment = False
+    if len(jobs) > 0:
 
-                        if is_comment_block:
-                            is_comment = True
-                        elif line.strip().startswith(("!", "//")):
-                            is_comment = True
-                        elif line.strip().startswith("/*"):
-                            is_comment = True
-                            is_comment_block = True
+        tokenizer = transformers.AutoTokenizer.from_pretrained(ckpt_dir)
+        if not server:
+            pipeline = engine.load_pipeline(ckpt_dir, workers["device"], precision)
+        engine.configure_padding(pipeline.tokenizer)
 
-                        if is_comment_block and line.strip().endswith("*/"):
-                            is_comment_block = False
+        template_tokens = engine.count_tokens(
+            pipeline.tokenizer, engine.create_conversation(instructions, [])
+        )
 
-                        if not is_comment:
-                            source_code.append(line)
+        if adaptive_budget:
+            output_ratio = budget.RatioStore(ratio_file).ratio(
+                budget.create_key(ckpt_dir, instructions), 1.5
+            )
+            api.display_output(
+                f"Sizing generation budgets for an output ratio of {output_ratio:.2f} "
+                + f"with a margin of {budget_margin}"
+            )
+        else:
+            output_ratio = 1.5
+
+        if chunk_tokens is None:
+            chunk_tokens = engine.chunk_budget(
+                transformers.AutoConfig.from_pretrained(ckpt_dir),
+                template_tokens,
+                max_new_tokens,
+                output_ratio,
+            )
+
+        api.display_output(f"Splitting sources into chunks of {chunk_tokens} tokens")
+
+        if not pipelined:
+            for job in jobs:
+                tasks.extend(prepare_job(job, pipeline.tokenizer))
+            display_normalization()
+
+        generate_kwargs = dict(
+            max_new_tokens=max_new_tokens,
+            max_length=max_length,
+            # temperature=temperature,
+            # top_p=top_p,
+            # do_sample=True,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=pipeline.tokenizer.pad_token_id,
+            early_stop=early_stop,
+        )
 
-                with open(tfile, "w") as destination:
-                    if tfile.endswith((".hpp",".cpp")):
-                        comment_start = "/*"
-                        comment_contd = " *"
-                        comment_end = "*/"
-                    elif tfile.endswith(".f90"):
-                        comment_start = "!!"
-                        comment_contd = "!!"
-                        comment_end = ""
-                    else:
-                        print(f"Cannot write to destination file: {tfile}")
-                        raise ValueError
-
-                    destination.write(f"{comment_start} LLM INSTRUCTIONS START\n")
-                    for line in instructions[0]["content"].split("\n"):
-                        destination.write(f"{comment_contd} {line}\n")
-                    destination.write(f"{comment_contd} LLM INSTRUCTIONS END {comment_end}\n\n")
-
-                    saved_prompt = instructions[-1]["content"]
-                    instructions[-1]["content"] += "\n" + "".join(source_code)
-
-                    results = pipeline(
-                        instructions,
-                        max_new_tokens=max_new_tokens,
-                        max_length=max_length,
-                        batch_size=batch_size,
-                        # temperature=temperature,
-                        # top_p=top_p,
-                        # do_sample=True,
-                        eos_token_id=tokenizer.eos_token_id,
-                        pad_token_id=50256,
+        if draft_ckpt:
+            api.display_output(f'Loading draft model from "{draft_ckpt}"')
+            speculative_kwargs = dict(
+                assistant_model=engine.load_model(
+                    draft_ckpt, workers["device"], precision
+                )
+            )
+            # Drafts from a model with another vocabulary are translated
+            # between tokenizers by transformers
+            draft_tokenizer = transformers.AutoTokenizer.from_pretrained(draft_ckpt)
+            if draft_tokenizer.get_vocab() != pipeline.tokenizer.get_vocab():
+                speculative_kwargs.update(
+                    tokenizer=pipeline.tokenizer, assistant_tokenizer=draft_tokenizer
+                )
+        elif prompt_lookup:
+            speculative_kwargs = dict(prompt_lookup_num_tokens=prompt_lookup)
+
+        if prefix_cache:
+            api.display_output("Prefilling template prefix for key/value cache reuse")
+            prefix = engine.create_prefix_cache(
+                pipeline.model, pipeline.tokenizer, instructions
+            )
+
+    def start_tasks(batch):
+        for task in batch:
+            if "start_time" not in task["job"]:
+                task["job"]["start_time"] = time.time()
+                if manifest_dir:
+                    defer(
+                        progress.record,
+                        task["job"]["target"],
+                        "started",
+                        hash=task["job"]["key"],
                     )
 
-                    for result in results:
-                        destination.write(result["generated_text"][-1]["content"])
-                        # code_block_indices = []
-                        # for index, line in enumerate(output_lines):
-                        #    if line[:2] == "```":
-                        #        code_block_indices.append(index)
-                        #
-                        # if len(code_block_indices) > 2:
-                        #    api.display_output(
-                        #        "More than one code blocks in LLM output"
-                        #    )
-                        #    raise NotImplementedError
-                        #
-                        # for index, line in enumerate(output_lines):
-                        #    if (
-                        #        index < code_block_indices[0]
-                        #        or index > code_block_indices[1]
-                        #    ):
-                        #        destination.write(f'// {line}"\n"')
-                        #    else:
-                        #        destination.write(f'{line}"\n"')
-                    instructions[-1]["content"] = saved_prompt
+    def fail_tasks(batch, error, bar):
+        label = ", ".join(
+            engine.create_label(task, mapping["src"]["dir"]) for task in batch
+        )
+        api.display_output(f"Conversion failed for {label}: {error}")
+        for job in {id(task["job"]): task["job"] for task in batch}.values():
+            if job.get("failed"):
+                continue
+            job["failed"] = True
+            if manifest_dir:
+                progress.record(
+                    job["target"], "failed", hash=job["key"], error=str(error)
+                )
+            if telemetry_file:
+                log.record(
+                    source=job["source"],
+                    target=job["target"],
+                    cache="miss" if cache_dir else "off",
+                    input_tokens=job["ntokens"],
+                    stop_reason="error",
+                    seconds=time.time() - job["start_time"],
+                    gpu_peak_mb=telemetry.peak_gpu_memory(workers["device"]),
+                )
+            bar()
+
+    # Source and output tokens of complete chunks, those that ended with
+    # end of sequence or the closing code fence
+    observed = dict(input_tokens=0, output_tokens=0, chunks=0)
+
+    def complete_task(task, result, bar):
+        job = task["job"]
+        if result["stop_reason"] in ("eos", "fence"):
+            observed["input_tokens"] += task["source_tokens"]
+            observed["output_tokens"] += result["output_tokens"]
+            observed["chunks"] += 1
+
+        job["outputs"][task["index"]] = result["output"]
+        job["stop_reasons"][task["index"]] = result["stop_reason"]
+        job["output_tokens"] += result["output_tokens"]
+        job["drafted"] += result.get("drafted", 0)
+        job["accepted"] += result.get("accepted", 0)
+
+        if job.get("failed") or None in job["outputs"]:
+            return
+
+        output = "\n".join(job["outputs"])
+        stop_reason = next(
+            (
+                reason
+                for reason in ["length", "repetition", "fence"]
+                if reason in job["stop_reasons"]
+            ),
+            "eos",
+        )
+        seconds = time.time() - job["start_time"]
+
+        if not stream:
+            engine.write_target(job["target"], instructions, output)
+        if verify_cpp:
+            verifier.submit(job["target"])
+        if cache_dir:
+            store.put(
+                job["key"],
+                output,
+                dict(
+                    source=job["source"],
+                    model=ckpt_dir,
+                    template=template,
+                    output_tokens=job["output_tokens"],
+                ),
+            )
+        if speculative:
+            stats = dict(drafted=job["drafted"], accepted=job["accepted"])
+            api.display_output(
+                f"Accepted {job['accepted']} of {job['drafted']} draft tokens "
+                + f"({job['accepted'] / max(job['drafted'], 1):.0%}) for "
+                + job["source"].replace(mapping["src"]["dir"] + os.sep, "")
+            )
+        else:
+            stats = dict()
+
+        if manifest_dir:
+            progress.record(
+                job["target"],
+                "done",
+                hash=job["key"],
+                chunks=len(job["outputs"]),
+                raw_tokens=job["raw_tokens"],
+                source_tokens=job["source_tokens"],
+                input_tokens=job["ntokens"],
+                output_tokens=job["output_tokens"],
+                stop_reason=stop_reason,
+                retries=job["retries"],
+                seconds=seconds,
+                **stats,
+            )
+        if telemetry_file:
+            log.record(
+                source=job["source"],
+                target=job["target"],
+                cache="miss" if cache_dir else "off",
+                input_tokens=job["ntokens"],
+                output_tokens=job["output_tokens"],
+                stop_reason=stop_reason,
+                seconds=seconds,
+                gpu_peak_mb=telemetry.peak_gpu_memory(workers["device"]),
+            )
+        bar()
+        # code_block_indices = []
+        # for index, line in enumerate(output_lines):
+        #    if line[:2] == "```":
+        #        code_block_indices.append(index)
+        #
+        # if len(code_block_indices) > 2:
+        #    api.display_output(
+        #        "More than one code blocks in LLM output"
+        #    )
+        #    raise NotImplementedError
+        #
+        # for index, line in enumerate(output_lines):
+        #    if (
+        #        index < code_block_indices[0]
+        #        or index > code_block_indices[1]
+        #    ):
+        #        destination.write(f'// {line}"\n"')
+        #    else:
+        #        destination.write(f'{line}"\n"')
+
+    def retry_task(task, result):
+        # Budgets below the global limit grow until the chunk fits
+        if (
+            result["stop_reason"] != "length"
+            or task["max_new_tokens"] >= max_new_tokens
+        ):
+            return False
+        task["max_new_tokens"] = min(2 * task["max_new_tokens"], max_new_tokens)
+        task["job"]["retries"] += 1
+        api.display_output(
+            f"Retrying {engine.create_label(task, mapping['src']['dir'])} "
+            + f"with {task['max_new_tokens']} new tokens"
+        )
+        return True
+
+    retries = []
 
+    def retry_batches(batches):
+        yield from batches
+        while retries:
+            pending = list(retries)
+            retries.clear()
+            if prefix_cache or speculative:
+                yield from [[task] for task in pending]
             else:
-                continue
+                yield from engine.create_batches(pending, batch_size)
+
+    def submit_task(batcher, task, bar):
+        input_ids = engine.encode(pipeline.tokenizer, task["conversation"])
+        future = batcher.submit(
+            input_ids,
+            min(task["max_new_tokens"], (max_length or math.inf) - len(input_ids)),
+            (
+                stopping.StopCheck(pipeline.tokenizer, **early_stop)
+                if early_stop
+                else None
+            ),
+        )
+        future.add_done_callback(functools.partial(complete_future, batcher, task, bar))
+
+    def complete_future(batcher, task, bar, future):
+        if future.exception():
+            fail_tasks([task], future.exception(), bar)
+        else:
+            output_ids, stop_reason = future.result()
+            result = engine.create_result(
+                pipeline.tokenizer, output_ids, stop_reason=stop_reason
+            )
+            if retry_task(task, result):
+                submit_task(batcher, task, bar)
+                return
+            bar.text(engine.create_label(task, mapping["src"]["dir"]))
+            complete_task(task, result, bar)
+
+    groups = [[] for wave in schedule]
+    if pipelined:
+        for job in jobs:
+            groups[job["wave"]].append(job)
+    else:
+        for task in tasks:
+            groups[task["job"]["wave"]].append(task)
+
+    with alive_bar(len(jobs), bar="blocks", disable=workers["rank"] != 0) as bar:
+
+        for group in groups:
+
+            if continuous and group:
+                telemetry.reset_gpu_memory(workers["device"])
+                start_tasks(group)
+                batcher = scheduler.ContinuousBatcher(
+                    pipeline.model,
+                    pipeline.tokenizer.eos_token_id,
+                    batch_size,
+                    max_tokens_in_flight,
+                )
+                for task in group:
+                    submit_task(batcher, task, bar)
+                batcher.run()
+                group = []
+
+            if pipelined:
+                batches = stream_batches(group)
+            elif prefix_cache or stream or speculative:
+                batches = [[task] for task in group]
+            else:
+                batches = engine.create_batches(group, batch_size)
+
+            for batch in retry_batches(batches):
+
+                batch = [task for task in batch if not task["job"].get("failed")]
+                if len(batch) == 0:
+                    continue
+
+                label = ", ".join(
+                    engine.create_label(task, mapping["src"]["dir"]) for task in batch
+                )
+                bar.text(label)
+                telemetry.reset_gpu_memory(workers["device"])
+                start_tasks(batch)
+                batch_kwargs = dict(
+                    generate_kwargs,
+                    max_new_tokens=max(task["max_new_tokens"] for task in batch),
+                )
+
+                try:
+                    if stream:
+                        streamer = engine.FileStreamer(
+                            pipeline.tokenizer,
+                            batch[0]["job"]["target"],
+                            instructions,
+                            bar,
+                            label,
+                            first=batch[0]["index"] == 0,
+                            last=batch[0]["index"]
+                            == len(batch[0]["job"]["outputs"]) - 1,
+                        )
+                        stream_kwargs = dict(streamer=streamer)
+                    else:
+                        stream_kwargs = dict()
+
+                    if speculative:
+                        results = [
+                            engine.generate_speculative(
+                                pipeline.model,
+                                pipeline.tokenizer,
+                                batch[0]["conversation"],
+                                **batch_kwargs,
+                                **speculative_kwargs,
+                                **stream_kwargs,
+                            )
+                        ]
+                    elif prefix_cache:
+                        results = [
+                            engine.generate_with_prefix(
+                                pipeline.model,
+                                pipeline.tokenizer,
+                                prefix,
+                                batch[0]["conversation"],
+                                **batch_kwargs,
+                                **stream_kwargs,
+                            )
+                        ]
+                    elif server:
+                        results = pipeline.generate(
+                            [task["conversation"] for task in batch],
+                            **batch_kwargs,
+                        )
+                    else:
+                        results = engine.generate_batch(
+                            pipeline.model,
+                            pipeline.tokenizer,
+                            [task["conversation"] for task in batch],
+                            **batch_kwargs,
+                            **stream_kwargs,
+                        )
+
+                except Exception as error:
+                    defer(fail_tasks, batch, error, bar)
+                    continue
+
+                for task, result in zip(batch, results):
+                    if retry_task(task, result):
+                        retries.append(task)
+                    else:
+                        defer(complete_task, task, result, bar)
+
+                if verify_cpp:
+                    defer(check_targets)
+
+            # Dependent files on other ranks wait for this wave to be written
+            if waves:
+                if pipelined:
+                    writer.join()
+                shard.barrier(workers)
+
+        # Queued writes still advance the progress bar
+        if pipelined:
+            writer.join()
+
+    if pipelined:
+        writer.close()
+        if jobs:
+            display_normalization()
+
+    failed = sum(1 for job in jobs if job.get("failed"))
+
+    if adaptive_budget:
+        observed = shard.gather(observed, workers)
+        if workers["rank"] == 0 and any(entry["chunks"] for entry in observed):
+            budget.RatioStore(ratio_file).update(
+                budget.create_key(ckpt_dir, instructions),
+                sum(entry["input_tokens"] for entry in observed),
+                sum(entry["output_tokens"] for entry in observed),
+                sum(entry["chunks"] for entry in observed),
+                model=ckpt_dir,
+                template=template,
+            )
+
+    if verify_cpp:
+        check_targets(wait=True)
+        verifier.shutdown()
+        api.display_output(
+            f"Rank {workers['rank']}: {verified} targets passed and "
+            + f"{invalid} failed the compile check"
+        )
+
+    summary = shard.gather(
+        dict(
+            files=len(source_files),
+            translated=len(jobs) - failed,
+            cached=cached,
+            failed=failed,
+            seconds=time.time() - start_time,
+        ),
+        workers,
+    )
+
+    if workers["rank"] == 0:
+        for rank, result in enumerate(summary):
+            api.display_output(
+                f"Rank {rank}: translated {result['translated']} and reused "
+                + f"{result['cached']} of {result['files']} files in {result['seconds']:.1f} s"
+                + f", {result['failed']} failed"
+            )
+        api.display_output(
+            f"Translated {sum(result['translated'] for result in summary)} of "
+            + f"{sum(result['files'] for result in summary)} files "
+            + f"on {workers['world_size']} workers"
+        )
+
+    shard.finalize_workers()
 
 
 if __name__ == "__main__":
@@ -5,6 +5,8 @@
 # be inserted into sys path in python files
 export LOCAL_PYMODULE_PATH="$PWD:$LOCAL_PYMODULE_PATH"
 
-# Execute torchrun command and deploy job.target
-torchrun --nproc_per_node 1 $JobWorkDir/job.target --filemap filemaps/funcs.toml \
-                                                   --template templates/funcs_updated.toml
+# Execute torchrun command and deploy job.target. Each worker loads its
+# own model replica and translates a shard of the filemap, so set
+# NPROC_PER_NODE to the number of GPUs requested from the schedular
+torchrun --nproc_per_node ${NPROC_PER_NODE:-1} $JobWorkDir/job.target --filemap filemaps/funcs.toml \
+                                                                     --template templates/funcs_updated.toml
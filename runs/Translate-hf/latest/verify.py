@@ -0,0 +1,188 @@
+# Module for compile checks of translated C++ files
+
+import os, re, json, shlex, hashlib, subprocess, concurrent.futures
+
+include_statement = re.compile(r'^\s*#\s*include\s*[<"]([^>"]+)[>"]', re.MULTILINE)
+
+code_block = re.compile(
+    r"^\s*```[ \t]*([\w+]*)[^\n]*\n(.*?)(^\s*```|\Z)", re.DOTALL | re.MULTILINE
+)
+
+fortran_unit = re.compile(
+    r"^\s*((recursive\s+|pure\s+)*(subroutine|function)|module|program|use)\b",
+    re.IGNORECASE,
+)
+
+
+def extract_code(text):
+    """
+    Return the C++ code of a target without the prose and fences around
+    it. Every chunk is answered with a fenced C++ block, Fortran blocks
+    such as the _fi.f90 interface are skipped. Text without fences is
+    returned unchanged.
+
+    Arguments
+    ---------
+    text : String value of target file content
+    """
+    blocks = []
+    for language, code, fence in code_block.findall(text):
+        if language.lower() in ["fortran", "f90", "f"]:
+            continue
+        lines = [line for line in code.split("\n") if line.strip()]
+        if lines and fortran_unit.match(lines[0]):
+            continue
+        blocks.append(code)
+
+    return "\n".join(blocks) if blocks else text
+
+
+def resolve_includes(tfile, include_dirs):
+    """
+    Return paths of local headers included by a file. Only headers found
+    next to the file or in include_dirs are returned, system headers
+    are skipped.
+
+    Arguments
+    ---------
+    tfile        : String value of C++ file path
+    include_dirs : List of include directories
+    """
+    with open(tfile, "r") as target:
+        names = include_statement.findall(target.read())
+
+    headers = []
+    for name in names:
+        for directory in [os.path.dirname(tfile)] + include_dirs:
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                headers.append(path)
+                break
+
+    return headers
+
+
+def run_compiler(command, source=None):
+    """
+    Run compiler command and return dictionary with success flag and
+    compiler diagnostics
+
+    Arguments
+    ---------
+    command : List of command line arguments
+    source  : String value passed on standard input
+    """
+    try:
+        process = subprocess.run(
+            command, input=source, capture_output=True, text=True, timeout=300
+        )
+    except subprocess.TimeoutExpired:
+        return dict(ok=False, errors="Compiler timed out")
+    except OSError as error:
+        return dict(ok=False, errors=str(error))
+
+    return dict(ok=process.returncode == 0, errors=process.stderr)
+
+
+class CompileVerifier:
+    """
+    Syntax check of translated C++ files in parallel. The code blocks of
+    every file are compiled on their own with -fsyntax-only by a pool of
+    compiler processes, so a file can be checked as soon as it is
+    written.
+    Results are cached by the content of the file, the local headers it
+    includes and the compiler command.
+
+    Arguments
+    ---------
+    include_dirs : List of include directories passed with -I
+    compiler     : String value of C++ compiler
+    flags        : String value of additional compiler flags
+    cache_dir    : String value of result cache directory, disabled if None
+    max_workers  : Integer value of concurrent compiler processes
+    """
+
+    def __init__(
+        self, include_dirs, compiler="g++", flags="", cache_dir=None, max_workers=4
+    ):
+        self.include_dirs = include_dirs
+        self.command = (
+            [compiler, "-fsyntax-only", "-x", "c++"]
+            + shlex.split(flags)
+            + [f"-I{directory}" for directory in include_dirs]
+        )
+        self.cache_dir = cache_dir
+        self.pending = {}
+
+        # Threads only wait for the compiler, which runs as its own process
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def create_key(self, tfile):
+        content = hashlib.sha256(json.dumps(self.command).encode())
+        for path in [tfile] + resolve_includes(tfile, self.include_dirs):
+            with open(path, "rb") as source:
+                content.update(source.read())
+        return content.hexdigest()
+
+    def submit(self, tfile):
+        """
+        Queue syntax check of a C++ file. Files with other extensions
+        are skipped.
+
+        Arguments
+        ---------
+        tfile : String value of C++ file path
+        """
+        if not tfile.endswith((".cpp", ".hpp", ".cc", ".hh", ".cxx", ".h")):
+            return
+
+        key = self.create_key(tfile)
+
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, f"verify-{key}.json")
+            if os.path.isfile(path):
+                with open(path, "r") as cached:
+                    future = concurrent.futures.Future()
+                    future.set_result(dict(json.load(cached), cached=True))
+                    self.pending[tfile] = future
+                    return
+
+        self.pending[tfile] = self.pool.submit(self.check, key, tfile)
+
+    def check(self, key, tfile):
+        with open(tfile, "r") as target:
+            source = extract_code(target.read())
+
+        # Code is compiled from standard input, quoted includes are
+        # searched next to the target
+        result = run_compiler(
+            self.command + ["-iquote", os.path.dirname(tfile) or ".", "-"], source
+        )
+
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, f"verify-{key}.json")
+            with open(path + ".tmp", "w") as cached:
+                json.dump(result, cached)
+            os.replace(path + ".tmp", path)
+
+        return dict(result, cached=False)
+
+    def collect(self, wait=False):
+        """
+        Return list of (file, result) tuples for finished checks
+
+        Arguments
+        ---------
+        wait : Boolean to wait for all queued checks
+        """
+        if wait:
+            concurrent.futures.wait(self.pending.values())
+
+        finished = [tfile for tfile, future in self.pending.items() if future.done()]
+        return [(tfile, self.pending.pop(tfile).result()) for tfile in finished]
+
+    def shutdown(self):
+        self.pool.shutdown()
@@ -0,0 +1,345 @@
+# Sweep of models and templates over a filemap with one model load per model
+
+# Import libraries
+import os, sys, json, time, toml
+
+for path in os.getenv("PYMODULE_PATH").split(":"):
+    sys.path.insert(0, path)
+
+import api, neucol, engine, lexer, verify
+
+from typing import Optional
+import fire, transformers, torch
+from alive_progress import alive_bar
+
+
+def resolve_checkpoint(model):
+    """
+    Return checkpoint directory for a model name from the model
+    selection menu or for a checkpoint directory
+
+    Arguments
+    ---------
+    model : String value of model name or checkpoint directory
+    """
+    if os.path.isdir(model):
+        return model
+
+    if model not in engine.checkpoints:
+        api.display_output(
+            f'Model "{model}" not defined, use a checkpoint directory or one of '
+            + ", ".join(engine.checkpoints)
+        )
+        raise ValueError
+
+    return os.getenv("MODEL_HOME") + os.sep + engine.checkpoints[model]
+
+
+def create_jobs(mapping, sources, templates, output_dir):
+    """
+    Create one job per combination of template and source file with
+    targets written below output_dir/<template>
+
+    Arguments
+    ---------
+    mapping    : Dictionary returned by neucol.create_src_mapping
+    sources    : Dictionary of normalized source lines per source file
+    templates  : Dictionary of template instructions per template name
+    output_dir : String value of output directory of the model
+    """
+    jobs = []
+    for template, instructions in templates.items():
+        for sfile, tfile in zip(mapping["src"]["files"], mapping["dest"]["files"]):
+            jobs.append(
+                dict(
+                    template=template,
+                    instructions=instructions,
+                    source=sfile,
+                    target=os.path.join(
+                        output_dir,
+                        template,
+                        os.path.relpath(tfile, mapping["dest"]["dir"]),
+                    ),
+                    source_code=sources[sfile],
+                    stop_reasons=[],
+                    output_tokens=0,
+                    seconds=0.0,
+                )
+            )
+    return jobs
+
+
+def verify_targets(jobs, flags, max_workers):
+    """
+    Syntax check the targets of one combination of model and template
+    and return the number of targets that passed. Every combination is
+    checked against its own headers.
+
+    Arguments
+    ---------
+    jobs        : List of finished jobs of the combination
+    flags       : String value of additional compiler flags
+    max_workers : Integer value of concurrent compiler processes
+    """
+    verifier = verify.CompileVerifier(
+        sorted(set(os.path.dirname(job["target"]) for job in jobs)),
+        os.getenv("CXX", "g++"),
+        flags,
+        max_workers=max_workers,
+    )
+    for job in jobs:
+        verifier.submit(job["target"])
+
+    passed = sum(result["ok"] for tfile, result in verifier.collect(wait=True))
+    verifier.shutdown()
+    return passed
+
+
+def summarize(model, template, jobs, compiled):
+    """
+    Return throughput and quality of one combination of model and
+    template. Generation time of a batch is split between its tasks by
+    their share of the generated tokens.
+
+    Arguments
+    ---------
+    model    : String value of model name
+    template : String value of template name
+    jobs     : List of jobs of the combination
+    compiled : Integer value of targets that passed the compile check,
+               None if not checked
+    """
+    finished = [job for job in jobs if not job.get("failed")]
+    output_tokens = sum(job["output_tokens"] for job in finished)
+    seconds = sum(job["seconds"] for job in jobs)
+
+    stop_reasons = {}
+    for job in finished:
+        for reason in job["stop_reasons"]:
+            stop_reasons[reason] = stop_reasons.get(reason, 0) + 1
+
+    return dict(
+        model=model,
+        template=template,
+        files=len(jobs),
+        failed=len(jobs) - len(finished),
+        output_tokens=output_tokens,
+        seconds=seconds,
+        tokens_per_second=output_tokens / max(seconds, 1e-9),
+        stop_reasons=stop_reasons,
+        compiled=compiled,
+        compile_rate=None if compiled is None else compiled / max(len(finished), 1),
+    )
+
+
+def main(
+    filemap: str,
+    templates: str,
+    models: str = "mistral-7b,codellama-7b,gemma-7b",
+    output_dir: str = "outputs",
+    max_new_tokens: int = 4096,
+    batch_size: int = 8,
+    chunk_tokens: Optional[int] = None,
+    precision: Optional[str] = None,
+    stop_at_fence: bool = True,
+    repetition_tokens: int = 0,
+    verify_cpp: bool = True,
+    verify_flags: str = "-std=c++17",
+    verify_workers: int = 4,
+    report: str = "sweep.json",
+):
+
+    models = models.split(",") if isinstance(models, str) else list(models)
+    templates = templates.split(",") if isinstance(templates, str) else list(templates)
+
+    device = 0 if torch.cuda.is_available() else "cpu"
+
+    mapping = neucol.create_src_mapping(filemap)
+
+    # Sources are read once and shared by all combinations
+    sources = {sfile: engine.read_source(sfile) for sfile in mapping["src"]["files"]}
+
+    template_names = {
+        os.path.splitext(os.path.basename(template))[0]: toml.load(template)[
+            "instructions"
+        ]
+        for template in templates
+    }
+
+    if stop_at_fence or repetition_tokens:
+        early_stop = dict(fence=stop_at_fence, repetition_tokens=repetition_tokens)
+    else:
+        early_stop = None
+
+    results = []
+
+    for model in models:
+        ckpt_dir = resolve_checkpoint(model)
+        name = model if model in engine.checkpoints else os.path.basename(ckpt_dir)
+
+        api.display_output(f'Loading "{ckpt_dir}" on {device}')
+        start_time = time.time()
+        pipeline = engine.load_pipeline(ckpt_dir, device, precision)
+        engine.configure_padding(pipeline.tokenizer)
+        load_seconds = time.time() - start_time
+
+        jobs = create_jobs(
+            mapping, sources, template_names, os.path.join(output_dir, name)
+        )
+
+        # All templates use the same chunks, sized for the longest template
+        budget = chunk_tokens or engine.chunk_budget(
+            transformers.AutoConfig.from_pretrained(ckpt_dir),
+            max(
+                engine.count_tokens(
+                    pipeline.tokenizer, engine.create_conversation(instructions, [])
+                )
+                for instructions in template_names.values()
+            ),
+            max_new_tokens,
+        )
+
+        chunks = {
+            sfile: lexer.create_chunks(
+                source_code,
+                lexer.is_fixed_form(sfile),
+                lambda lines: len(
+                    pipeline.tokenizer("".join(lines), add_special_tokens=False)[
+                        "input_ids"
+                    ]
+                ),
+                budget,
+            )
+            for sfile, source_code in sources.items()
+        }
+
+        tasks = []
+        for job in jobs:
+            job["outputs"] = [None] * len(chunks[job["source"]])
+            for index, chunk in enumerate(chunks[job["source"]]):
+                conversation = engine.create_conversation(job["instructions"], chunk)
+                tasks.append(
+                    dict(
+                        job=job,
+                        index=index,
+                        conversation=conversation,
+                        ntokens=engine.count_tokens(pipeline.tokenizer, conversation),
+                    )
+                )
+
+        api.display_output(
+            f"Translating {len(mapping['src']['files'])} files with "
+            + f"{len(template_names)} templates in {len(tasks)} tasks"
+        )
+
+        # Tasks of all templates are batched together by prompt length
+        with alive_bar(len(tasks), bar="blocks") as bar:
+            for batch in engine.create_batches(tasks, batch_size):
+                bar.text(
+                    ", ".join(
+                        engine.create_label(task, mapping["src"]["dir"])
+                        for task in batch
+                    )
+                )
+                start_time = time.time()
+                try:
+                    outputs = engine.generate_batch(
+                        pipeline.model,
+                        pipeline.tokenizer,
+                        [task["conversation"] for task in batch],
+                        early_stop=early_stop,
+                        max_new_tokens=max_new_tokens,
+                        do_sample=False,
+                        eos_token_id=pipeline.tokenizer.eos_token_id,
+                        pad_token_id=pipeline.tokenizer.pad_token_id,
+                    )
+                except Exception as error:
+                    api.display_output(f"Generation failed: {error}")
+                    for task in batch:
+                        task["job"]["failed"] = True
+                    bar(len(batch))
+                    continue
+                seconds = time.time() - start_time
+
+                total_tokens = sum(result["output_tokens"] for result in outputs)
+                for task, result in zip(batch, outputs):
+                    job = task["job"]
+                    job["outputs"][task["index"]] = result["output"]
+                    job["stop_reasons"].append(result["stop_reason"])
+                    job["output_tokens"] += result["output_tokens"]
+                    job["seconds"] += seconds * (
+                        result["output_tokens"] / total_tokens
+                        if total_tokens
+                        else 1 / len(batch)
+                    )
+                    bar()
+
+        for job in jobs:
+            if not job.get("failed"):
+                os.makedirs(os.path.dirname(job["target"]), exist_ok=True)
+                engine.write_target(
+                    job["target"], job["instructions"], "\n".join(job["outputs"])
+                )
+
+        for template in template_names:
+            combination = [job for job in jobs if job["template"] == template]
+            compiled = (
+                verify_targets(
+                    [job for job in combination if not job.get("failed")],
+                    verify_flags,
+                    verify_workers,
+                )
+                if verify_cpp
+                else None
+            )
+            result = summarize(name, template, combination, compiled)
+            result["load_seconds"] = load_seconds
+            results.append(result)
+
+        del pipeline
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    # Matrix of models by templates with throughput and compile rate
+    width = max(len(result["model"]) for result in results)
+    api.display_output(
+        " " * width + "".join(f"  {template:>24}" for template in template_names)
+    )
+    for model in dict.fromkeys(result["model"] for result in results):
+        row = model.ljust(width)
+        for template in template_names:
+            result = next(
+                result
+                for result in results
+                if result["model"] == model and result["template"] == template
+            )
+            cell = f"{result['tokens_per_second']:.1f} tok/s"
+            if result["compile_rate"] is not None:
+                cell += f", {result['compile_rate']:.0%} ok"
+            row += f"  {cell:>24}"
+        api.display_output(row)
+
+    with open(report, "w") as outfile:
+        json.dump(
+            dict(
+                config=dict(
+                    filemap=filemap,
+                    templates=templates,
+                    models=models,
+                    max_new_tokens=max_new_tokens,
+                    batch_size=batch_size,
+                    precision=precision,
+                    early_stop=early_stop,
+                    device=str(device),
+                ),
+                results=results,
+            ),
+            outfile,
+            indent=2,
+        )
+
+    api.display_output(f'Sweep results written to "{report}"')
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
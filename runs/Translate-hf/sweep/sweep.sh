@@ -0,0 +1,14 @@
+# Shell script for comparing models and templates with the
+# code-translation engine. This script executes job.target defined in
+# Jobfile.
+
+# Use the engine modules from latest, translated files are written to
+# outputs/<model>/<template> instead of the MCFM source tree
+export PYMODULE_PATH="$PWD/../latest:$PYMODULE_PATH"
+
+# Execute python command and deploy job.target. Every model is loaded
+# once and translates the filemap with all templates, so request a GPU
+# that fits the largest model
+python3 $JobWorkDir/job.target --filemap ../latest/filemaps/funcs.toml \
+                               --templates ../latest/templates/funcs.toml,../latest/templates/funcs_farray_v2.toml,../latest/templates/funcs_updated.toml \
+                               --models ${SWEEP_MODELS:-mistral-7b,codellama-7b,gemma-7b}
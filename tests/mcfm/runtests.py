@@ -0,0 +1,163 @@
+# Incremental MCFM build and concurrent process checks
+
+# Import libraries
+import os, sys, json, time, shutil, subprocess, concurrent.futures, toml
+
+from typing import Optional
+import fire
+
+red = "\033[91m"
+green = "\033[92m"
+end = "\033[0m"
+
+
+def run_command(command, cwd, timeout=None):
+    """
+    Run command and return dictionary with return code, wall time and
+    the tail of the combined output
+
+    Arguments
+    ---------
+    command : List of command line arguments
+    cwd     : String value of working directory
+    timeout : Float value of seconds before the command is stopped
+    """
+    start_time = time.time()
+    try:
+        process = subprocess.run(
+            command,
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            timeout=timeout,
+        )
+        returncode, output = process.returncode, process.stdout
+    except subprocess.TimeoutExpired as error:
+        returncode, output = None, f"Timed out after {timeout} s\n{error.output or ''}"
+    except OSError as error:
+        returncode, output = None, str(error)
+
+    return dict(
+        ok=returncode == 0,
+        returncode=returncode,
+        seconds=time.time() - start_time,
+        output=output[-8192:],
+    )
+
+
+def build(mcfm_home, jobs, clean=False):
+    """
+    Configure MCFM and rebuild it incrementally. Configuring again picks
+    up translated files added since the last build and is cheap on an
+    existing build directory. Make only recompiles objects whose
+    sources or headers changed.
+
+    Arguments
+    ---------
+    mcfm_home : String value of MCFM directory
+    jobs      : Integer value of parallel make jobs
+    clean     : Boolean to remove the install and build from scratch
+    """
+    build_dir = os.path.join(mcfm_home, "Bin")
+    install_dir = os.path.join(mcfm_home, "install")
+
+    if clean:
+        shutil.rmtree(install_dir, ignore_errors=True)
+        run_command(["make", "clean"], build_dir)
+
+    result = dict(
+        configure=run_command(
+            [
+                "cmake",
+                "-DCMAKE_Fortran_COMPILER=gfortran",
+                "-DCMAKE_C_COMPILER=gcc",
+                "-DCMAKE_CXX_COMPILER=g++",
+                f"-DCMAKE_INSTALL_PREFIX={install_dir}",
+                "..",
+            ],
+            build_dir,
+        )
+    )
+    if not result["configure"]["ok"]:
+        return dict(ok=False, **result)
+
+    result["make"] = run_command(["make", f"-j{jobs}", "install"], build_dir)
+    return dict(ok=result["make"]["ok"], **result)
+
+
+def main(
+    tests: str = "tests.toml",
+    mcfm_home: Optional[str] = None,
+    select: Optional[str] = None,
+    jobs: Optional[int] = None,
+    workers: Optional[int] = None,
+    timeout: float = 3600,
+    clean: bool = False,
+    report: str = "report.json",
+):
+    mcfm_home = mcfm_home or os.getenv("MCFM_HOME")
+    jobs = jobs or os.cpu_count()
+    workers = workers or os.cpu_count()
+
+    checks = toml.load(tests)["tests"]
+    if select:
+        names = select.split(",") if isinstance(select, str) else list(select)
+        checks = [check for check in checks if check["name"] in names]
+
+    start_time = time.time()
+
+    print(f"Building MCFM in {mcfm_home} with {jobs} jobs")
+    results = dict(build=build(mcfm_home, jobs, clean), tests=[])
+
+    if not results["build"]["ok"]:
+        print(f"{red}Build failed, skipping tests{end}")
+        step = results["build"].get("make") or results["build"]["configure"]
+        print(step["output"][-2048:])
+    else:
+        print(f"Build finished in {results['build']['make']['seconds']:.1f} s")
+
+        # Tests are separate processes, threads only wait for them
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            futures = {
+                pool.submit(
+                    run_command,
+                    ["./test"] + check["args"],
+                    os.path.join(mcfm_home, "Bin"),
+                    timeout,
+                ): check
+                for check in checks
+            }
+            for future in concurrent.futures.as_completed(futures):
+                check = futures[future]
+                result = dict(
+                    name=check["name"],
+                    args=check["args"],
+                    directories=check["directories"],
+                    **future.result(),
+                )
+                results["tests"].append(result)
+                print(
+                    f"{green if result['ok'] else red}"
+                    + f"{'PASS' if result['ok'] else 'FAIL'} {result['name']} "
+                    + f"in {result['seconds']:.1f} s{end}"
+                )
+
+    results["tests"].sort(key=lambda result: result["name"])
+    results["seconds"] = time.time() - start_time
+    passed = sum(result["ok"] for result in results["tests"])
+
+    print(
+        f"{passed} of {len(checks)} tests passed in {results['seconds']:.1f} s, "
+        + f'report written to "{report}"'
+    )
+
+    with open(report, "w") as outfile:
+        json.dump(results, outfile, indent=2)
+
+    if not results["build"]["ok"] or passed < len(checks):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -1,19 +1,10 @@
-cd $MCFM_HOME/Bin
-rm -rf $MCFM_HOME/install
+# Shell script for building MCFM and running its process checks. This
+# script executes job.target defined in Jobfile.
 
-# Compile and install
-make clean || true
-cmake -DCMAKE_Fortran_COMPILER=gfortran -DCMAKE_C_COMPILER=gcc -DCMAKE_CXX_COMPILER=g++ \
-      -DCMAKE_INSTALL_PREFIX=$MCFM_HOME/install ..
-make install
-
-./test -b u d~ ve e+ # Directories: W (converted)
-./test -b u d~ ve e+ g # Directories: W1jet
-./test -b u d~ ve e+ g g # Directories: W2jet, BDK, loop
-./test -b u u~ e- e+ # Directories: Z (converted)
-./test -b u u~ e- e+ g # Directories: Z1jet, loop
-./test -b u u~ e- e+ g g # Directories: Z2jet, W2jet, BDK, loop
-./test -b -Pmodel=heft g g h # Directories: ggH (converted)
-./test -b g g h # Directories: ggH (converted)
-./test -b g g g g g # Directories: ThreeJets (partially converted)
-./test -b g g h g g # Directories: gghgg_dep
+# Rebuild incrementally with parallel make and run the ./test process
+# checks in tests.toml concurrently. Set MCFM_CLEAN_BUILD=True to wipe
+# the install and rebuild from scratch, and MCFM_TESTS to a comma
+# separated list of test names to run a subset.
+python3 $JobWorkDir/job.target --tests tests.toml \
+                               --clean ${MCFM_CLEAN_BUILD:-False} \
+                               ${MCFM_TESTS:+--select $MCFM_TESTS}